@@ -1,6 +1,52 @@
+import time
 import pygame
 import pygame.display
 from pygame.locals import *
+from gui import dirty_region, layout, input_dispatcher, POINTER_EVENTS
+from mainloop import waker, main, timers
+from eventbus import bus
+import log
+
+WAKE_EVENT = pygame.USEREVENT + 1
+
+
+class FrameStats:
+    """Frame time, idle percentage and wakeups, averaged over `interval` seconds."""
+    interval = 10.0
+
+    def __init__(self):
+        self.start = time.time()
+        self.frames = 0
+        self.busy = 0.0
+        self.wakeups = 0
+        self.frame_time = 0.0
+        self.idle_percent = 0.0
+        self.wakeups_per_sec = 0.0
+
+    def add_frame(self, busy):
+        self.frames += 1
+        self.busy += busy
+
+    def add_wakeup(self):
+        self.wakeups += 1
+
+    def update(self):
+        elapsed = time.time() - self.start
+        if elapsed < self.interval:
+            return False
+        self.frame_time = self.busy / max(self.frames, 1)
+        self.idle_percent = 100.0 * max(elapsed - self.busy, 0.0) / elapsed
+        self.wakeups_per_sec = self.wakeups / elapsed
+        self.start += elapsed
+        self.frames = 0
+        self.busy = 0.0
+        self.wakeups = 0
+        return True
+
+    def report(self):
+        return "frame %.1fms, idle %.0f%%, %.1f wakeups/sec" % (
+            self.frame_time * 1000.0, self.idle_percent, self.wakeups_per_sec)
+
 
 class App:
     def __init__(self):
@@ -11,7 +57,16 @@ class App:
         self.clock = pygame.time.Clock()
         self.FPS = 30
         self.objects = list(())
+        # Hit testing needs the order objects are drawn in
+        input_dispatcher.roots = self.objects
+        self.full_redraw = True
+        self.updated_rects = list(())
+        # Block between frames until input, telemetry or an invalidation arrives
+        self.idle_wait = True
+        self.wake_event = None
+        self.stats = FrameStats()
         pygame.init()
+        waker.set_handler(self.wake)
 
     def init_display(self):
         pygame.display.init()
@@ -34,21 +89,52 @@ class App:
 
     def add_object(self, object):
         self.objects.append(object)
+        self.full_redraw = True
 
     def remove_object(self, object):
         self.objects.remove(object)
+        self.full_redraw = True
 
     def on_key_down(self, event):
         if event.key == pygame.K_ESCAPE:
             self.running = False
 
+    def wake(self):
+        # Called from other threads through mainloop.waker
+        pygame.event.post(pygame.event.Event(WAKE_EVENT))
+
+    def has_work(self):
+        return waker.pending or main.calls or timers.due() or bus.queue or dirty_region.rects or layout.roots or self.full_redraw or pygame.event.peek()
+
+    def wait(self):
+        waker.sleeping = True
+        if self.running and not self.has_work():
+            # pygame.event.wait has no timeout, so have SDL post a wake up when the next timer is due
+            delay = timers.next_delay()
+            if delay is not None:
+                pygame.time.set_timer(WAKE_EVENT, max(int(delay * 1000) + 1, 1))
+            self.wake_event = pygame.event.wait()
+            if delay is not None:
+                pygame.time.set_timer(WAKE_EVENT, 0)
+            self.stats.add_wakeup()
+        waker.sleeping = False
+
     def process_events(self):
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        if self.wake_event is not None:
+            events.insert(0, self.wake_event)
+            self.wake_event = None
+        for event in events:
+            if event.type == WAKE_EVENT:
+                continue
             if event.type == pygame.QUIT:
                 self.running = False
             if event.type == pygame.KEYDOWN:
                 self.on_key_down(event)
             else:
+                input_dispatcher.dispatch(event)
+                if event.type in POINTER_EVENTS:
+                    continue
                 for object in self.objects:
                     object.event(event)
 
@@ -66,27 +152,61 @@ class App:
         pass
 
     def render(self):
-        self.screen.fill(self.bg_color)
-        for object in self.objects:
-            object.render(self.screen)
+        if self.full_redraw:
+            self.full_redraw = False
+            dirty_region.clear()
+            self.screen.fill(self.bg_color)
+            for object in self.objects:
+                object.render(self.screen)
+            self.updated_rects = None
+            return
+
+        # Only restore the background and redraw under what changed
+        self.updated_rects = dirty_region.take()
+        for rect in self.updated_rects:
+            self.screen.set_clip(rect)
+            self.screen.fill(self.bg_color, rect)
+            for object in self.objects:
+                object.render(self.screen)
+        self.screen.set_clip(None)
 
     def post_render(self):
         pass
 
     def run(self):
         while self.running:
+            start = time.time()
+            waker.clear()
             self.process_events()
+            # Handlers other threads queued for the main thread
+            main.drain()
+            timers.run_due()
 
             self.pre_render()
             self.update()
             self.post_update()
+            # Events coalesced for batched handlers during this frame
+            bus.flush()
+            # Absolute positions of everything moved this frame, before rendering it
+            layout.update()
 
             self.pre_render()
             self.render()
             self.post_render()
 
-            pygame.display.flip()
+            if self.updated_rects is None:
+                pygame.display.flip()
+            elif self.updated_rects:
+                pygame.display.update(self.updated_rects)
+            self.stats.add_frame(time.time() - start)
+            if self.stats.update():
+                log.debug("App: %s", self.stats.report())
+
+            # FPS is now a cap, frames only run while something changes
             self.clock.tick(self.FPS)
+            if self.idle_wait:
+                self.wait()
 
     def set_bg_color(self, color):
         self.bg_color = (color[0], color[1], color[2])
+        self.full_redraw = True
@@ -0,0 +1,191 @@
+import json
+import os
+from collections import OrderedDict
+import pygame
+
+# Shared cache of decoded images, fonts, descriptor JSON and sounds.
+# Widgets load through here so creating the same widget twice, or re-entering a
+# screen, doesn't touch the SD card again:
+#
+#   image = assets.image('ui/PNG/glassPanel.png')
+#   ...
+#   assets.release(image)
+#
+# When an atlas index built by atlas.py is loaded, images packed into it come back as
+# subsurfaces of the atlas pages rather than being decoded from their own files.
+
+
+class Asset:
+    def __init__(self, key, value, size):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.refs = 0
+
+
+class AssetCache:
+    """
+    Every get() adds a reference and every release() drops one. Assets nobody
+    references stay cached until the total estimated size goes over `budget`,
+    then they are evicted least recently used first. Referenced assets are never evicted.
+    """
+
+    def __init__(self, budget=16 * 1024 * 1024):
+        self.budget = budget
+        self.total = 0
+        self.entries = OrderedDict()
+        self.keys = dict()
+        self.hits = 0
+        self.misses = 0
+        self.atlas = dict()
+        self.parents = dict()
+
+    def get(self, key, loader):
+        asset = self.entries.pop(key, None)
+        if asset is None:
+            self.misses += 1
+            value, size = loader()
+            asset = Asset(key, value, size)
+            self.keys[id(value)] = key
+            self.total += size
+        else:
+            self.hits += 1
+        # Most recently used last
+        self.entries[key] = asset
+        asset.refs += 1
+        self.evict()
+        return asset.value
+
+    def release(self, value):
+        key = self.keys.get(id(value))
+        if key is None:
+            return
+        asset = self.entries[key]
+        if asset.refs > 0:
+            asset.refs -= 1
+        self.evict()
+
+    def evict(self):
+        if self.total <= self.budget:
+            return
+        parents = list(())
+        for key, asset in list(self.entries.items()):
+            if self.total <= self.budget:
+                break
+            if asset.refs == 0:
+                del self.entries[key]
+                del self.keys[id(asset.value)]
+                self.total -= asset.size
+                if id(asset.value) in self.parents:
+                    parents.append(self.parents.pop(id(asset.value)))
+        for parent in parents:
+            self.release(parent)
+
+    def clear(self):
+        self.entries.clear()
+        self.keys.clear()
+        self.parents.clear()
+        self.total = 0
+
+    def load_atlas(self, index_path):
+        # Index written by atlas.py, images packed into it are served as subsurfaces of its pages
+        with open(index_path) as f:
+            index = json.load(f)
+        pages = index['pages']
+        for path, (page, x, y, w, h) in index['frames'].items():
+            self.atlas[path] = (pages[page], pygame.Rect(x, y, w, h))
+
+    def image(self, path, alpha=True):
+        frame = self.atlas.get(path)
+        if frame is not None and alpha:
+            page_path, rect = frame
+
+            def load_frame():
+                # The page stays referenced until the frame is evicted
+                page = self.image(page_path)
+                frame = page.subsurface(rect)
+                self.parents[id(frame)] = page
+                return frame, 0
+            return self.get(('image', path, alpha), load_frame)
+
+        def load():
+            surface = pygame.image.load(path)
+            if alpha:
+                surface = surface.convert_alpha()
+            return surface, surface_size(surface)
+        return self.get(('image', path, alpha), load)
+
+    def derived(self, parent, name, build):
+        # Built from another cached asset, e.g. glyphs rendered from a font. The parent
+        # keeps a reference until this is evicted, so it is never evicted first
+        parent_key = self.keys.get(id(parent))
+
+        def load():
+            value = build()
+            asset = self.entries.get(parent_key)
+            if asset is not None:
+                asset.refs += 1
+                self.parents[id(value)] = parent
+            return value, 0
+        return self.get(('derived', parent_key if parent_key is not None else id(parent)) + name, load)
+
+    def font(self, path, size):
+        def load():
+            return pygame.font.Font(path, size), os.path.getsize(path)
+        return self.get(('font', path, size), load)
+
+    def descriptor(self, path):
+        # Parsed .slc/.bar JSON, shared so callers must not modify it
+        def load():
+            with open(path) as f:
+                return json.load(f), os.path.getsize(path)
+        return self.get(('descriptor', path), load)
+
+    def sound(self, path):
+        def load():
+            sound = pygame.mixer.Sound(path)
+            return sound, sound_size(sound)
+        return self.get(('sound', path), load)
+
+
+def surface_size(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+def sound_size(sound):
+    mixer = pygame.mixer.get_init()
+    if mixer is None:
+        return 0
+    frequency, size, channels = mixer
+    return int(sound.get_length() * frequency * channels * abs(size) / 8)
+
+
+cache = AssetCache()
+
+
+def load_atlas(index_path):
+    cache.load_atlas(index_path)
+
+
+def image(path, alpha=True):
+    return cache.image(path, alpha)
+
+
+def derived(parent, name, build):
+    return cache.derived(parent, name, build)
+
+
+def font(path, size):
+    return cache.font(path, size)
+
+
+def descriptor(path):
+    return cache.descriptor(path)
+
+
+def sound(path):
+    return cache.sound(path)
+
+
+def release(value):
+    cache.release(value)
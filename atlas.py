@@ -0,0 +1,95 @@
+import glob
+import json
+import os
+import sys
+import pygame
+from utils import print_console
+
+# Offline atlas builder. Packs every image referenced by the .bar and .slc
+# descriptors under ui/ into atlas pages plus an index, so the app decodes a
+# single PNG at startup instead of one per widget piece:
+#
+#   python atlas.py [ui_dir]
+#
+# Re-run it whenever a descriptor or one of its images changes. assets.load_atlas()
+# picks the index up at startup and falls back to the loose files for anything missing.
+
+INDEX_NAME = 'atlas.json'
+PAGE_NAME = 'atlas_%d.png'
+MAX_SIZE = 1024
+PADDING = 1
+
+
+def referenced_images(ui_dir):
+    paths = list(())
+    descriptors = glob.glob(os.path.join(ui_dir, '*.bar')) + glob.glob(os.path.join(ui_dir, '*', '*.slc'))
+    for descriptor in sorted(descriptors):
+        with open(descriptor) as f:
+            data = json.load(f)
+        for key in sorted(data.keys()):
+            value = data[key]
+            if isinstance(value, basestring) and value.endswith('.png') and value not in paths:
+                paths.append(value)
+    return paths
+
+
+def pack(sizes, max_size):
+    """
+    Shelf packing: tallest images first, left to right, starting a new shelf when
+    a row is full and a new page when a page is full.
+    Returns {index: (page, x, y)} and the used size of each page.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    placements = dict()
+    pages = [[0, 0]]
+    x = y = shelf = 0
+    for i in order:
+        w = sizes[i][0] + PADDING
+        h = sizes[i][1] + PADDING
+        if x + w > max_size:
+            x = 0
+            y += shelf
+            shelf = 0
+        if y + h > max_size:
+            pages.append([0, 0])
+            x = y = shelf = 0
+        placements[i] = (len(pages) - 1, x, y)
+        page = pages[-1]
+        page[0] = max(page[0], x + w)
+        page[1] = max(page[1], y + h)
+        x += w
+        shelf = max(shelf, h)
+    return placements, pages
+
+
+def build(ui_dir='ui'):
+    paths = referenced_images(ui_dir)
+    images = [pygame.image.load(path) for path in paths]
+    sizes = [image.get_size() for image in images]
+    placements, page_sizes = pack(sizes, MAX_SIZE)
+
+    pages = [pygame.Surface(size, pygame.SRCALPHA, 32) for size in page_sizes]
+    for page in pages:
+        page.fill((0, 0, 0, 0))
+
+    frames = dict()
+    for i, path in enumerate(paths):
+        page, x, y = placements[i]
+        # Blitting onto fully transparent pixels copies the source unchanged
+        pages[page].blit(images[i], (x, y))
+        frames[path] = [page, x, y, sizes[i][0], sizes[i][1]]
+
+    page_paths = list(())
+    for i, page in enumerate(pages):
+        page_path = os.path.join(ui_dir, PAGE_NAME % i)
+        pygame.image.save(page, page_path)
+        page_paths.append(page_path)
+
+    with open(os.path.join(ui_dir, INDEX_NAME), 'w') as f:
+        json.dump({'pages': page_paths, 'frames': frames}, f, indent=4, sort_keys=True)
+    print_console("Packed %d images into %d page(s): %s" % (len(paths), len(pages), ', '.join(
+        "%s %dx%d" % (page_paths[i], page.get_width(), page.get_height()) for i, page in enumerate(pages))))
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else 'ui')
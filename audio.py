@@ -0,0 +1,120 @@
+import threading
+import time
+import pygame
+import assets
+import log
+
+# Sound effects with low trigger latency. The mixer is opened with a small buffer
+# before pygame.init() gets to it with the defaults, effects are decoded into memory
+# at startup, and they play on a fixed pool of reserved channels:
+#
+#   audio.engine.init()
+#   audio.engine.load('fire', 'fire.mp3')
+#   handler = audio.engine.bind(tagmsg.on_trigger, 'fire')
+#
+# play() is safe to call from the BLE worker thread, so binding on_trigger starts a
+# shot sound straight from the notification instead of after the next main loop frame.
+
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def report(self):
+        if self.count == 0:
+            return "no samples"
+        return "%d plays, %.1f ms avg, %.1f ms max" % (self.count, self.total * 1000 / self.count, self.max * 1000)
+
+
+class AudioEngine:
+    """
+    `voices` channels are reserved for effects. A play takes a free channel, or steals
+    the one that started longest ago, so full auto keeps firing instead of dropping shots
+    once every channel is busy.
+    """
+
+    def __init__(self, frequency=22050, size=-16, channels=2, buffer=256, voices=8):
+        self.frequency = frequency
+        self.size = size
+        self.channels = channels
+        self.buffer = buffer
+        self.voices = voices
+        self.pool = list(())
+        self.started = list(())
+        self.sounds = dict()
+        self.lock = threading.Lock()
+        self.stolen = 0
+        self.latency = LatencyStats()
+
+    def init(self):
+        # Must run before pygame.init(), which would open the mixer with a large default buffer
+        pygame.mixer.pre_init(self.frequency, self.size, self.channels, self.buffer)
+        pygame.mixer.init(self.frequency, self.size, self.channels, self.buffer)
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), self.voices))
+        pygame.mixer.set_reserved(self.voices)
+        self.pool = [pygame.mixer.Channel(i) for i in range(self.voices)]
+        self.started = [0.0] * self.voices
+        log.info("Audio: %d Hz, %d sample buffer (%.1f ms), %d voices", self.frequency, self.buffer,
+                 self.buffer * 1000.0 / self.frequency, self.voices)
+
+    def load(self, name, path):
+        # Sound decodes the whole file to PCM in the mixer's format, nothing is decoded at play time
+        sound = assets.sound(path)
+        self.sounds[name] = sound
+        return sound
+
+    def unload(self, name):
+        sound = self.sounds.pop(name, None)
+        if sound is not None:
+            assets.release(sound)
+
+    def voice(self):
+        oldest = 0
+        for index, channel in enumerate(self.pool):
+            if not channel.get_busy():
+                return index
+            if self.started[index] < self.started[oldest]:
+                oldest = index
+        self.stolen += 1
+        return oldest
+
+    def play(self, name, stamp=None):
+        sound = self.sounds.get(name)
+        if sound is None or not self.pool:
+            return
+        with self.lock:
+            index = self.voice()
+            self.started[index] = time.time()
+            self.pool[index].play(sound)
+        if stamp is not None:
+            # From the notification arriving to the mixer having the sound
+            self.latency.add(self.started[index] - stamp)
+
+    def bind(self, trigger_signal, name):
+        # Plays `name` for every non-empty trigger, keep the handler to unbind it
+        def handler(sender, empty, stamp):
+            if not empty:
+                self.play(name, stamp)
+        trigger_signal.connect(handler)
+        return handler
+
+    def unbind(self, trigger_signal, handler):
+        trigger_signal.disconnect(handler)
+
+    def report(self):
+        return "%s, %d stolen" % (self.latency.report(), self.stolen)
+
+    def close(self):
+        for name in list(self.sounds.keys()):
+            self.unload(name)
+        log.info("Audio: %s", self.report())
+
+
+engine = AudioEngine()
@@ -0,0 +1,432 @@
+import os
+import struct
+import sys
+import time
+import timeit
+from telemetry import *
+from utils import print_console
+from simtagger import SimTagger
+import simtagger
+
+# Micro benchmarks for the hot paths. Run on the Pi with:
+#   python bench.py [name ...]
+
+
+def make_frames(count, repeat):
+    # The tagger repeats a frame until something changes, so each distinct
+    # frame is sent `repeat` times
+    frames = list(())
+    for i in range(count):
+        data = [0x00] * FRAME_SIZE
+        data[1] = 0x01
+        data[3] = (i // repeat) & 0x0f
+        data[7] = 0x64
+        data[14] = 30 - ((i // repeat) % 30)
+        frames.append(struct.pack('20B', *data))
+    return frames
+
+
+def legacy_decode(data, state):
+    # The previous DataDelegate + Tagger.read_telemetry path, minus the signals
+    data_bytes = struct.unpack("20B", data)
+    player_id = data_bytes[1]
+    buttons = data_bytes[2]
+    fire_btn_count = data_bytes[3] & 0x0f
+    reload_btn_count = data_bytes[3] & 0xf0
+    back_btn_count = data_bytes[4] & 0x0f
+    power_btn_count = data_bytes[5] & 0x0f
+    state.battery_level = data_bytes[7]
+    if fire_btn_count != state.fire_btn_count:
+        state.fire_btn_count = fire_btn_count
+    if reload_btn_count != state.reload_btn_count:
+        state.reload_btn_count = reload_btn_count
+    if back_btn_count != state.back_btn_count:
+        state.back_btn_count = back_btn_count
+    if power_btn_count != state.power_btn_count:
+        state.power_btn_count = power_btn_count
+    ammo_count = data_bytes[14]
+    if ammo_count != state.ammo_count:
+        state.ammo_count = ammo_count
+    if player_id != state.player_id:
+        state.player_id = player_id
+    byte10 = data_bytes[10]
+    event_id = (byte10 & 0xF)
+    if event_id != 0 and event_id != state.ir_event_id:
+        state.ir_payload = data_bytes[8] | (data_bytes[9] << 8)
+
+
+class DecodeState(object):
+    # The fields Tagger keeps between frames
+    player_id = 0
+    fire_btn_count = 0
+    reload_btn_count = 0
+    back_btn_count = 0
+    power_btn_count = 0
+    battery_level = 0
+    ammo_count = 0
+    ir_event_id = 0
+    ir_payload = 0
+
+
+def decoder_decode(decoder, data, state):
+    # TelemetryDecoder + the checks Tagger.read_telemetry makes, minus the signals
+    values = decoder.decode(data)
+    if values is None:
+        return
+    player_id, buttons, counters, back, power, battery, payload, event, ammo = values
+    fire_btn_count = counters & 0x0f
+    reload_btn_count = counters & 0xf0
+    back_btn_count = back & 0x0f
+    power_btn_count = power & 0x0f
+    state.battery_level = battery
+    if fire_btn_count != state.fire_btn_count:
+        state.fire_btn_count = fire_btn_count
+    if reload_btn_count != state.reload_btn_count:
+        state.reload_btn_count = reload_btn_count
+    if back_btn_count != state.back_btn_count:
+        state.back_btn_count = back_btn_count
+    if power_btn_count != state.power_btn_count:
+        state.power_btn_count = power_btn_count
+    if ammo != state.ammo_count:
+        state.ammo_count = ammo
+    if player_id != state.player_id:
+        state.player_id = player_id
+    event_id = event & 0xF
+    if event_id != 0 and event_id != state.ir_event_id:
+        state.ir_payload = payload
+
+
+def report(name, count, seconds):
+    print_console("%-28s %10.0f per sec" % (name, count / seconds))
+
+
+def bench_reconnect():
+    simtagger.install()
+    import mainloop
+    import tagger
+    import tagmsg
+    drops = 10
+    outage = 3.0
+    print_console("reconnect supervisor, %d link drops then a %.0f s outage" % (drops, outage))
+    tagger.record_telemetry_path = None
+    tagger.gatt_cache_path = None
+    sim = simtagger.add_device(SimTagger('00:00:00:00:00:E0', rate=100.0))
+    sim.round_trip = 0.03
+    handlers = tagmsg.handler_count(tagmsg)
+    service = tagger.TaggerService()
+    service.backoff_base = 0.25
+    service.try_connect()
+
+    def run_until(state, timeout=30.0):
+        end = time.time() + timeout
+        while service.link_state != state and time.time() < end:
+            mainloop.main.drain()
+            mainloop.timers.run_due()
+            service.update()
+            time.sleep(0.01)
+
+    def run_for(seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            mainloop.main.drain()
+            mainloop.timers.run_due()
+            service.update()
+            time.sleep(0.01)
+
+    run_until(tagger.LINK_STREAMING)
+    streaming = tagmsg.handler_count(tagmsg)
+    for i in range(drops):
+        sim.drop()
+        run_until(tagger.LINK_RECOVERING)
+        run_until(tagger.LINK_STREAMING)
+    simtagger.remove_device(sim.addr)
+    sim.drop()
+    run_until(tagger.LINK_RECOVERING)
+    run_for(outage)
+    simtagger.add_device(sim)
+    run_until(tagger.LINK_STREAMING)
+    print_console("  %s" % service.report())
+    print_console("  tagmsg handlers: %d before, %d streaming, %d after %d reconnects" % (
+        handlers, streaming, tagmsg.handler_count(tagmsg), len(service.stats.reconnects)))
+    service.stop()
+    print_console("  tagmsg handlers after stop: %d" % tagmsg.handler_count(tagmsg))
+    simtagger.remove_device(sim.addr)
+
+
+def bench_telemetry():
+    count = 20000
+    for repeat in (1, 10):
+        frames = make_frames(count, repeat)
+        state = DecodeState()
+
+        def legacy():
+            for data in frames:
+                legacy_decode(data, state)
+
+        decoder = TelemetryDecoder()
+        decoded = DecodeState()
+
+        def decode():
+            for data in frames:
+                decoder_decode(decoder, data, decoded)
+
+        print_console("telemetry frames, each repeated %d time(s)" % repeat)
+        report("  struct.unpack('20B')", count, min(timeit.repeat(legacy, number=1, repeat=5)))
+        report("  TelemetryDecoder", count, min(timeit.repeat(decode, number=1, repeat=5)))
+
+
+def bench_pool():
+    simtagger.install()
+    import tagger
+    rate = 1000.0
+    seconds = 3.0
+    print_console("tagger pool, %.0f notifications/sec offered per device, 30 FPS main loop" % rate)
+    for count in (1, 2, 4, 8):
+        pool = tagger.TaggerPool()
+        sims = list(())
+        for i in range(count):
+            sim = simtagger.add_device(SimTagger('00:00:00:00:00:%02X' % i, rate=rate))
+            sims.append(sim)
+            pool.add(simtagger.SimScanEntry(sim))
+        start = time.time()
+        while time.time() - start < seconds:
+            # Only the battery byte moves, so frames are decoded but nothing is logged
+            for sim in sims:
+                sim.set_battery(int(time.time() * 1000) & 0xff)
+            pool.update()
+            time.sleep(1.0 / 30)
+        elapsed = time.time() - start
+        received = sum(t.telemetry_count for t in pool.taggers.values())
+        dropped = sum(t.frames.dropped for t in pool.taggers.values())
+        pool.stop()
+        for sim in sims:
+            simtagger.remove_device(sim.addr)
+        report("  %d tagger(s)" % count, received, elapsed)
+        print_console("  %-28s %10d dropped" % ('', dropped))
+        time.sleep(0.5)
+
+
+def bench_panels():
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    import pygame
+    import gui
+    import slicesprite
+    pygame.display.init()
+    pygame.display.set_mode((640, 480), 0, 32)
+    surface = pygame.Surface((640, 480), 0, 32)
+
+    class LegacySliceSprite(slicesprite.SliceSprite):
+        # Regenerates on every placement and shares nothing, like SliceSprite used to
+        def set_rect(self, new_rect):
+            self._rect = pygame.Rect(new_rect)
+            self._regenerate_slices = True
+
+        def _generate_slices(self):
+            self._sliced_image = slicesprite.generate_slices(self._image, self._slicing,
+                                                             self._rect.width, self._rect.height)
+
+    count = 50
+    panels = list(())
+    # Node.position ignores the current position, so every repeat moves somewhere new
+    offset = [0]
+
+    def create():
+        for panel in panels:
+            panel.release()
+        del panels[:]
+        for i in range(count):
+            panel = gui.Panel('ui/PNG/metalPanel_blueCorner.slc', 320, 240)
+            panel.render(surface)
+            panels.append(panel)
+
+    def move():
+        offset[0] += 1
+        for i, panel in enumerate(panels):
+            panel.position(i + offset[0], i + offset[0])
+        # The App's per frame layout pass
+        gui.layout.update()
+        for panel in panels:
+            panel.render(surface)
+
+    print_console("%d panels of 320x240" % count)
+    for name, sprite_class in (('regenerate', LegacySliceSprite), ('slice cache', slicesprite.SliceSprite)):
+        gui.SliceSprite = sprite_class
+        slicesprite.slice_cache.clear()
+        report("  create, %s" % name, count, min(timeit.repeat(create, number=1, repeat=5)))
+        report("  move, %s" % name, count, min(timeit.repeat(move, number=1, repeat=5)))
+    gui.SliceSprite = slicesprite.SliceSprite
+    for panel in panels:
+        panel.release()
+    print_console("  %-28s %10d queued for layout" % ('', len(gui.layout.roots)))
+    pygame.display.quit()
+
+
+def bench_audio():
+    simtagger.install()
+    import pygame
+    import tagger
+    from audio import AudioEngine
+    engine = AudioEngine()
+    engine.init()
+    engine.load('fire', 'fire.mp3')
+    rate = 100.0
+    shots = 40
+    print_console("trigger to mixer latency, %.0f notifications/sec, 30 FPS main loop" % rate)
+
+    pool = tagger.TaggerPool()
+    sim = simtagger.add_device(SimTagger('00:00:00:00:00:A0', rate=rate, ammo=shots + 1))
+    device = pool.add(simtagger.SimScanEntry(sim))
+    pulled = [0.0]
+    main_loop = list(())
+
+    def fired(sender, empty):
+        # The old path: on_press_fire from the main loop, then Sound.play()
+        main_loop.append(time.time() - pulled[0])
+
+    device.signals.on_press_fire.connect(fired)
+    worker = engine.bind(device.signals.on_trigger, 'fire')
+    worker_latency = list(())
+
+    def played(sender, empty, stamp):
+        worker_latency.append(time.time() - pulled[0])
+
+    device.signals.on_trigger.connect(played)
+
+    frame = 0
+    while len(main_loop) < shots:
+        if frame % 7 == 3 and len(main_loop) == frame // 7:
+            pulled[0] = time.time()
+            sim.pull_trigger()
+        pool.update()
+        time.sleep(1.0 / 30)
+        frame += 1
+    pool.stop()
+    simtagger.remove_device(sim.addr)
+    engine.unbind(device.signals.on_trigger, worker)
+
+    def summary(name, samples):
+        print_console("  %-26s %6.1f ms avg %6.1f ms max" % (name, sum(samples) * 1000 / len(samples), max(samples) * 1000))
+
+    summary("on_press_fire, main loop", main_loop)
+    summary("on_trigger, BLE worker", worker_latency)
+    print_console("  mixer buffer %.1f ms, %s" % (engine.buffer * 1000.0 / engine.frequency, engine.report()))
+    engine.close()
+    pygame.mixer.quit()
+
+
+def bench_connect():
+    simtagger.install()
+    import tagger
+    round_trip = 0.03
+    connects = 5
+    print_console("connect to first notification, %.0f ms per GATT request" % (round_trip * 1000))
+    tagger.gatt_cache_path = None
+    pool = tagger.TaggerPool()
+    sim = simtagger.add_device(SimTagger('00:00:00:00:00:C0', rate=100.0))
+    sim.round_trip = round_trip
+
+    def connect():
+        device = pool.add(simtagger.SimScanEntry(sim))
+        while device.connect_latency is None:
+            pool.update()
+            time.sleep(0.001)
+        pool.remove(sim.addr)
+        device.worker.join()
+        return device.connect_latency
+
+    def summary(name, samples):
+        print_console("  %-26s %6.1f ms avg %6.1f ms max" % (name, sum(samples) * 1000 / len(samples), max(samples) * 1000))
+
+    discovery = list(())
+    for i in range(connects):
+        pool.gatt_cache.clear()
+        discovery.append(connect())
+    cached = [connect() for i in range(connects)]
+    # A firmware update moved the handles, the cached connect fails over to discovery.
+    # Moved down by 2 the old CCCD is a command handle, which accepts the write
+    stale = list(())
+    for i in range(connects):
+        sim.handle_offset = -2 if i % 2 else 3
+        stale.append(connect())
+    pool.stop()
+    simtagger.remove_device(sim.addr)
+
+    summary("service discovery", discovery)
+    summary("cached handles", cached)
+    summary("stale cache", stale)
+    print_console("  cache: %s" % pool.gatt_cache.report())
+
+
+def bench_events():
+    from blinker import Signal
+    from eventbus import Event, EventBus
+    count = 100000
+    data = make_frames(1, 1)[0]
+    stamp = time.time()
+
+    class Receiver:
+        def __init__(self):
+            self.count = 0
+
+        def blinker_telemetry(self, sender, **kw):
+            if 'data' not in kw:
+                return
+            self.count += 1
+
+        def telemetry(self, sender, data, stamp):
+            self.count += 1
+
+        def ammo(self, sender, ammo):
+            self.count += 1
+
+    print_console("%d telemetry events" % count)
+    for receivers in (1, 4):
+        targets = [Receiver() for i in range(receivers)]
+        signal = Signal('telemetry')
+        event = Event('telemetry', ('data', 'stamp'))
+        for target in targets:
+            signal.connect(target.blinker_telemetry)
+            event.connect(target.telemetry)
+
+        def blinker_send():
+            for i in range(count):
+                signal.send(None, data=data, stamp=stamp)
+
+        def event_send():
+            for i in range(count):
+                event.send(None, data, stamp)
+
+        report("  blinker, %d receiver(s)" % receivers, count, min(timeit.repeat(blinker_send, number=1, repeat=3)))
+        report("  Event, %d receiver(s)" % receivers, count, min(timeit.repeat(event_send, number=1, repeat=3)))
+
+    # Full auto ammo updates, many per frame but the UI only wants the last
+    bus = EventBus()
+    event = Event('ammo_change', ('ammo',), bus)
+    target = Receiver()
+    event.connect(target.ammo, batched=True)
+
+    def batched_send():
+        for i in range(count):
+            event.send(None, i)
+            if i % 100 == 0:
+                bus.flush()
+
+    report("  Event, batched per 100", count, min(timeit.repeat(batched_send, number=1, repeat=3)))
+    print_console("  %-28s %10d delivered" % ('', target.count))
+
+
+benchmarks = {
+    'audio': bench_audio,
+    'connect': bench_connect,
+    'events': bench_events,
+    'panels': bench_panels,
+    'pool': bench_pool,
+    'reconnect': bench_reconnect,
+    'telemetry': bench_telemetry,
+}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
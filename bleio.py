@@ -0,0 +1,333 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from bluepy.btle import Scanner, Characteristic, BTLEException
+import log
+from mainloop import waker, main, Context
+
+
+class FrameQueue:
+    """
+    Bounded hand-off of telemetry frames from the BLE thread to the main loop.
+    deque.append and deque.popleft are atomic, so with one producer and one consumer
+    no lock is needed. If the main loop falls behind the oldest frames are dropped;
+    the button and ammo fields are running values, so the newest frame always catches up.
+    """
+
+    def __init__(self, size=64):
+        self.frames = deque(maxlen=size)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame):
+        if len(self.frames) == self.frames.maxlen:
+            self.dropped += 1
+        self.frames.append(frame)
+        waker.wake()
+
+    def get(self):
+        try:
+            return self.frames.popleft()
+        except IndexError:
+            return None
+
+
+class PendingWrite:
+    def __init__(self, characteristic, data, key, queued):
+        self.characteristic = characteristic
+        self.data = data
+        self.key = key
+        self.queued = queued
+
+
+class CommandQueue:
+    """
+    Characteristic writes for one tagger. Only its BLE thread touches the queue, other
+    threads reach put() through the worker's I/O context, so nothing here is locked.
+    A write queued with a key replaces a pending write with the same key in place,
+    so a burst of config changes goes out once with the last value.
+    """
+    no_response = Characteristic.props["WRITE_NO_RESP"]
+
+    def __init__(self):
+        self.pending = deque()
+        self.keyed = dict()
+        self.written = 0
+        self.coalesced = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, characteristic, data, key=None, queued=None):
+        if key is not None:
+            write = self.keyed.get(key)
+            if write is not None:
+                write.data = data
+                self.coalesced += 1
+                return
+        write = PendingWrite(characteristic, data, key, queued or time.time())
+        self.pending.append(write)
+        if key is not None:
+            self.keyed[key] = write
+
+    def get(self):
+        if not self.pending:
+            return None
+        write = self.pending.popleft()
+        if write.key is not None:
+            del self.keyed[write.key]
+        return write
+
+    def flush(self):
+        write = self.get()
+        while write is not None:
+            characteristic = write.characteristic
+            # Skip the round trip when the tagger accepts write commands
+            with_response = (characteristic.properties & self.no_response) == 0
+            characteristic.write(write.data, with_response)
+
+            latency = time.time() - write.queued
+            self.written += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            write = self.get()
+
+    def report(self):
+        average = 0.0
+        if self.written > 0:
+            average = self.total_latency / self.written
+        return "depth %d, written %d, coalesced %d, latency avg %.1fms max %.1fms" % (
+            len(self.pending), self.written, self.coalesced, average * 1000.0, self.max_latency * 1000.0)
+
+
+class GattCache:
+    """
+    Attribute handles and tagger type per MAC address, saved as JSON so a reconnect,
+    even after a restart, can enable notifications by handle instead of running
+    service discovery. An entry is only a hint: a connect that fails with it drops
+    the entry and discovers again. Connects run on the BLE threads, so access is locked,
+    and changes are saved from the main loop rather than during the connect.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning("Ignoring GATT cache %s: %s", self.path, e)
+            return
+        with self.lock:
+            self.entries = entries
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, indent=4, sort_keys=True)
+        # Replace the file in one step so a crash never leaves half an entry behind
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning("Could not save GATT cache %s: %s", self.path, e)
+
+    def get(self, addr):
+        with self.lock:
+            entry = self.entries.get(addr)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, addr, entry):
+        with self.lock:
+            self.entries[addr] = entry
+        self.changed()
+
+    def invalidate(self, addr):
+        with self.lock:
+            entry = self.entries.pop(addr, None)
+            if entry is not None:
+                self.stale += 1
+        if entry is not None:
+            self.changed()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        self.changed()
+
+    def changed(self):
+        if self.path is not None:
+            main.call(self.save)
+
+    def report(self):
+        return "%d entries, %d hits, %d misses, %d stale" % (len(self.entries), self.hits, self.misses, self.stale)
+
+
+class TaggerWorker(threading.Thread):
+    """
+    Owns the tagger's Peripheral. Connects, then loops on waitForNotifications so the
+    render loop never blocks on BLE. bluepy is not thread safe, so writes requested by
+    other threads go through a CommandQueue and are issued from here between waits.
+    Handlers connected with `context` run here too, between waits.
+    """
+    poll_timeout = 0.1
+
+    def __init__(self, tagger):
+        threading.Thread.__init__(self, name='tagger-ble')
+        self.daemon = True
+        self.tagger = tagger
+        self.commands = CommandQueue()
+        self.context = Context('tagger-io')
+        self.running = True
+        self.connected = False
+
+    def write(self, characteristic, data, key=None):
+        # Stamped here so the reported latency includes the hop to this thread
+        self.context.call(self.commands.put, characteristic, data, key, time.time())
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.context.bind()
+        try:
+            self.tagger.connect()
+            self.connected = True
+            waker.wake()
+            while self.running:
+                self.context.drain()
+                self.commands.flush()
+                self.tagger.peripheral.waitForNotifications(self.poll_timeout)
+        except BTLEException as e:
+            log.warning("BLE worker stopped: %s", e)
+        finally:
+            self.connected = False
+            self.tagger.disconnected()
+            self.disconnect()
+            waker.wake()
+            log.info("Commands: %s", self.commands.report())
+
+    def disconnect(self):
+        peripheral = self.tagger.peripheral
+        if peripheral is None:
+            return
+        try:
+            peripheral.disconnect()
+        except BTLEException:
+            pass
+
+
+class DiscoveredDevice:
+    def __init__(self, entry):
+        self.entry = entry
+        self.addr = entry.addr
+        self.rssi = entry.rssi
+        self.last_seen = time.time()
+
+
+class DiscoveryCache:
+    """
+    Recoil taggers heard by the ScanWorker, keyed by MAC address.
+    Written from the scan thread and read from the main loop, so access is locked.
+    """
+    max_age = 5.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = dict()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def update(self, entry):
+        with self.lock:
+            device = self.devices.get(entry.addr)
+            if device is None:
+                self.devices[entry.addr] = DiscoveredDevice(entry)
+                waker.wake()
+            else:
+                device.entry = entry
+                device.rssi = entry.rssi
+                device.last_seen = time.time()
+
+    def remove(self, addr):
+        with self.lock:
+            self.devices.pop(addr, None)
+
+    def clear(self):
+        with self.lock:
+            self.devices.clear()
+
+    def recent(self):
+        oldest = time.time() - self.max_age
+        with self.lock:
+            return [device for device in self.devices.values() if device.last_seen >= oldest]
+
+    def find(self):
+        # Strongest tagger heard recently, or None
+        oldest = time.time() - self.max_age
+        best = None
+        with self.lock:
+            for device in self.devices.values():
+                if device.last_seen < oldest:
+                    continue
+                if best is None or device.rssi > best.rssi:
+                    best = device
+        return best
+
+
+class ScanWorker(threading.Thread):
+    """
+    Runs one continuous bluepy scan instead of restarting it for every poll.
+    Advertisements are reported through the delegate. Each worker has its own
+    Scanner so a stopping worker never shares a helper with its replacement.
+    """
+    process_timeout = 0.5
+
+    def __init__(self, delegate):
+        threading.Thread.__init__(self, name='tagger-scan')
+        self.daemon = True
+        self.scanner = Scanner().withDelegate(delegate)
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        try:
+            self.scanner.start()
+            while self.running:
+                self.scanner.process(self.process_timeout)
+        except BTLEException as e:
+            log.warning("Scan worker stopped: %s", e)
+        finally:
+            try:
+                self.scanner.stop()
+            except BTLEException:
+                pass
+            # Whoever waits to connect until the scan is over
+            waker.wake()
@@ -0,0 +1,113 @@
+from collections import deque
+import mainloop
+
+# Typed events for the tagger messages in tagmsg. Each event has a fixed positional
+# payload, declared by its field names, and handlers are called as
+# handler(sender, *payload):
+#
+#   on_ammo_changed = Event('ammo_change', ('ammo',))
+#   on_ammo_changed.connect(ammo_changed)          # ammo_changed(sender, ammo)
+#   on_ammo_changed.send(self, 30)
+#
+# Handlers are plain strong references kept in a tuple that is only rebuilt on
+# connect/disconnect, so a handler left connected keeps its owner alive and running.
+# Owners connect through a Subscriptions and release it when they go away:
+#
+#   self.subscriptions = Subscriptions()
+#   self.subscriptions.connect(tagmsg.on_ammo_changed, self.ammo_changed)
+#   ...
+#   self.subscriptions.release()
+#
+# Events are sent from the main loop, the BLE workers and timers. A handler that
+# touches state owned by one thread declares it when connecting, and sends from other
+# threads are queued to that thread instead of calling it directly:
+#
+#   tagmsg.on_message.connect(self.message, context=mainloop.main)
+
+
+class Event(object):
+    """
+    Immediate handlers run inside send(), on the sending thread unless connected with
+    a mainloop context. Handlers connected with batched=True run on the main thread and
+    only see the latest payload of each frame: send() stores it and bus.flush(), called
+    once per frame from App.run, delivers it.
+    """
+    __slots__ = ('name', 'fields', 'handlers', 'batched', 'pending', 'bus')
+
+    def __init__(self, name, fields=(), bus=None):
+        self.name = name
+        self.fields = fields
+        self.handlers = ()
+        self.batched = ()
+        self.pending = None
+        self.bus = bus
+
+    def connect(self, handler, batched=False, context=None):
+        if batched:
+            if handler not in self.batched:
+                self.batched += (handler,)
+        elif handler not in self.handlers:
+            if context is not None:
+                handler = context.handler(handler)
+            self.handlers += (handler,)
+        return handler
+
+    def disconnect(self, handler):
+        self.handlers = tuple(h for h in self.handlers if h != handler)
+        self.batched = tuple(h for h in self.batched if h != handler)
+
+    @property
+    def receivers(self):
+        return self.handlers + self.batched
+
+    def send(self, sender, *args):
+        for handler in self.handlers:
+            handler(sender, *args)
+        if self.batched:
+            mainloop.main.call(self.post, sender, *args)
+
+    def post(self, sender, *args):
+        if self.pending is None:
+            (self.bus or bus).queue.append(self)
+        self.pending = (sender,) + args
+
+    def deliver(self):
+        args = self.pending
+        self.pending = None
+        if args is not None:
+            for handler in self.batched:
+                handler(*args)
+
+    def __repr__(self):
+        return "<Event %s%r>" % (self.name, self.fields)
+
+
+class Subscriptions(object):
+    """The handlers one owner connected, release() disconnects all of them."""
+
+    def __init__(self):
+        self.connected = list(())
+
+    def __len__(self):
+        return len(self.connected)
+
+    def connect(self, event, handler, batched=False, context=None):
+        self.connected.append((event, event.connect(handler, batched, context)))
+
+    def release(self):
+        for event, handler in self.connected:
+            event.disconnect(handler)
+        self.connected = list(())
+
+
+class EventBus:
+    def __init__(self):
+        self.queue = deque()
+
+    def flush(self):
+        # Events batched while delivering are left for the next frame
+        for i in range(len(self.queue)):
+            self.queue.popleft().deliver()
+
+
+bus = EventBus()
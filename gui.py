@@ -1,18 +1,233 @@
+import time
 import pygame
 import pygame.display
 from pygame.locals import *
 from slicesprite import SliceSprite
-import json
+import assets
+from mainloop import waker, timers
+
+
+class DirtyRegion:
+    """
+    Screen areas that changed since the last frame. Nodes add the rects they
+    invalidate and App.render only redraws and updates those.
+    """
+
+    def __init__(self):
+        self.rects = list(())
+
+    def add(self, rect):
+        if rect.width > 0 and rect.height > 0:
+            self.rects.append(pygame.Rect(rect))
+            # Invalidated from another thread, e.g. a message from the BLE worker
+            waker.wake()
+
+    def clear(self):
+        self.rects = list(())
+
+    def take(self):
+        # Swapped out in one step, a rect added by another thread meanwhile lands in
+        # either this frame's list or the next one
+        rects, self.rects = self.rects, list(())
+        # Merge overlapping rects so each area is only redrawn once
+        merged = list(())
+        for rect in rects:
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+
+dirty_region = DirtyRegion()
+
+
+class GlyphCache:
+    """
+    Antialiased glyphs for one (font, color), each rendered once. Only for text drawn
+    a character at a time in fixed cells, like NumberLabel's digits: composing whole
+    strings from it would lose the font's kerning.
+    """
+
+    def __init__(self, font, color):
+        self.font = font
+        self.color = color
+        self.glyphs = dict()
+        self.height = font.get_height()
+
+    def glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.font.render(char, True, self.color)
+            self.glyphs[char] = glyph
+        return glyph
+
+
+def glyph_cache(font, color):
+    # Shared through assets like the font itself, release it when done
+    return assets.derived(font, ('glyphs', tuple(color)), lambda: GlyphCache(font, color))
+
+
+class Layout:
+    """
+    Nodes whose absolute position went stale since the last frame. App.run calls
+    update() once per frame, which recomputes each moved subtree top-down, so a
+    move costs one pass over the nodes it actually moved.
+    """
+
+    def __init__(self):
+        self.roots = list(())
+
+    def add(self, node):
+        self.roots.append(node)
+
+    def remove(self, node):
+        if node.layout_pending:
+            node.layout_pending = False
+            if node in self.roots:
+                self.roots.remove(node)
+
+    def update(self):
+        if not self.roots:
+            return
+        roots = self.roots
+        self.roots = list(())
+        # Parents first, so a child queued under a moved parent is laid out with it
+        roots.sort(key=lambda node: node.depth())
+        for node in roots:
+            if not node.layout_pending:
+                continue
+            container = node.container
+            node.layout((0, 0) if container is None else container.get_abs_pos())
+            node.invalidate()
+
+
+layout = Layout()
+
+
+POINTER_EVENTS = (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION)
+
+
+class InputDispatcher:
+    """
+    Routes events to the widgets that subscribed to their type instead of every node.
+    Pointer events go only to the topmost subscribed widget under the pointer, found
+    through a grid of `cell` sized buckets over the widgets' absolute rects, so a hit
+    test looks at the few widgets sharing one bucket. The topmost widget is the one
+    drawn last, App sets `roots` to its objects so their order counts too.
+    """
+    cell = 64
+
+    def __init__(self):
+        self.roots = list(())
+        self.subscriptions = dict()
+        self.order = dict()
+        self.rects = dict()
+        self.cells = dict()
+        self.handlers = dict()
+        self.count = 0
+
+    def subscribe(self, node, event_types):
+        self.unsubscribe(node)
+        self.count += 1
+        self.order[node] = self.count
+        self.subscriptions[node] = frozenset(event_types)
+        for event_type in event_types:
+            self.handlers.setdefault(event_type, list()).append(node)
+        self.update(node)
+
+    def unsubscribe(self, node):
+        event_types = self.subscriptions.pop(node, None)
+        if event_types is None:
+            return
+        for event_type in event_types:
+            self.handlers[event_type].remove(node)
+        self.remove_rect(node)
+        del self.order[node]
+
+    def cell_keys(self, rect):
+        for x in range(rect.left // self.cell, (rect.right - 1) // self.cell + 1):
+            for y in range(rect.top // self.cell, (rect.bottom - 1) // self.cell + 1):
+                yield x, y
+
+    def remove_rect(self, node):
+        rect = self.rects.pop(node, None)
+        if rect is None:
+            return
+        for key in self.cell_keys(rect):
+            bucket = self.cells[key]
+            bucket.remove(node)
+            if not bucket:
+                del self.cells[key]
+
+    def update(self, node):
+        # Re-index after the node moved or resized, the layout pass calls this for subscribers
+        self.remove_rect(node)
+        rect = pygame.Rect(node.get_abs_pos(), node.get_size())
+        if rect.width <= 0 or rect.height <= 0:
+            return
+        self.rects[node] = rect
+        for key in self.cell_keys(rect):
+            self.cells.setdefault(key, list()).append(node)
+
+    def render_key(self, node):
+        # Sorts in draw order: containers draw their children in order after their own
+        # background, layered ones their static children first
+        key = list(())
+        while node._container is not None:
+            container = node._container
+            key.append((container.layered and not node.static, container.children.index(node)))
+            node = container
+        key.append((False, self.roots.index(node) if node in self.roots else -1))
+        key.reverse()
+        return key
+
+    def hit(self, pos, event_type):
+        hits = [node for node in self.cells.get((pos[0] // self.cell, pos[1] // self.cell), ())
+                if event_type in self.subscriptions[node] and self.rects[node].collidepoint(pos)]
+        if len(hits) < 2:
+            return hits[0] if hits else None
+        return max(hits, key=lambda node: (self.render_key(node), self.order[node]))
+
+    def dispatch(self, event):
+        if event.type in POINTER_EVENTS:
+            node = self.hit(event.pos, event.type)
+            if node is not None:
+                node.event(event)
+            return
+        for node in tuple(self.handlers.get(event.type, ())):
+            node.event(event)
+
+
+input_dispatcher = InputDispatcher()
+
+
+class LayerTarget:
+    """Lets nodes that render at absolute positions draw into a layer surface whose top left is `origin`."""
+
+    def __init__(self, surface, origin):
+        self.surface = surface
+        self.origin = origin
+
+    def blit(self, source, dest, area=None, special_flags=0):
+        return self.surface.blit(source, (dest[0] - self.origin[0], dest[1] - self.origin[1]), area, special_flags)
 
 
 class Node(object):
     _container = None
-    dirty = False
+    # Drawn into the container's cached layer instead of every frame, see Container.set_layered
+    static = False
+    # abs_pos is stale, and so is every descendant's
+    dirty = True
+    layout_pending = False
     abs_pos = (0, 0)
     pos = (0, 0)
 
     def __init__(self):
-        pass
+        # Not queued for layout until it is moved or added to a container, abs_pos is
+        # worked out on demand until then
+        self.acquired = list(())
 
     @property
     def container(self):
@@ -21,64 +236,208 @@ class Node(object):
     @container.setter
     def container(self, container):
         self._container = container
-        self.dirty = True
+        if container is None:
+            self.dirty_subtree()
+        else:
+            self.mark_dirty()
 
     def position(self, x, y):
+        if (x, y) == self.pos:
+            return
+        self.invalidate()
         self.pos = (x, y)
-        self.dirty = True
+        self.mark_dirty()
 
-    def get_abs_pos(self):
-        if self._container is None:
-            #print str(type(self)) + "No Container: " + str(self.pos)
-            return self.pos
+    def mark_dirty(self):
+        # Queue this subtree for the next layout pass
+        self.dirty_subtree()
+        if not self.layout_pending:
+            self.layout_pending = True
+            layout.add(self)
+
+    def dirty_subtree(self):
+        self.dirty = True
 
-        if self.dirty is not True:
-            return self.abs_pos
+    def depth(self):
+        depth = 0
+        node = self._container
+        while node is not None:
+            depth += 1
+            node = node.container
+        return depth
 
-        container_pos = self._container.get_abs_pos()
+    def layout(self, container_pos):
         self.abs_pos = (self.pos[0] + container_pos[0], self.pos[1] + container_pos[1])
-        #print str(type(self)) + "Dirty: ", self.abs_pos
         self.dirty = False
+        self.layout_pending = False
+        self.on_layout()
+        if self in input_dispatcher.subscriptions:
+            input_dispatcher.update(self)
+
+    def on_layout(self):
+        # Called with abs_pos up to date after this node or one of its containers moved
+        pass
+
+    def get_size(self):
+        return 0, 0
+
+    def get_rect(self):
+        return pygame.Rect(self.get_abs_pos(), self.get_size())
+
+    def invalidate(self):
+        self.invalidate_rect(self.get_rect())
+
+    def invalidate_rect(self, rect):
+        dirty_region.add(rect)
+        # Any layer this node is drawn into has to be rebuilt
+        node = self
+        while node._container is not None:
+            if node.static:
+                node._container.layer_dirty = True
+            node = node._container
+
+    def acquire(self, value):
+        # Remember a shared asset so release() can hand it back to the cache
+        self.acquired.append(value)
+        return value
+
+    def release(self):
+        input_dispatcher.unsubscribe(self)
+        layout.remove(self)
+        for value in self.acquired:
+            assets.release(value)
+        self.acquired = list(())
+
+    def get_abs_pos(self):
+        # Normally up to date from the layout pass, this only walks up between a move and the next pass
+        if self.dirty:
+            if self._container is None:
+                self.abs_pos = self.pos
+            else:
+                container_pos = self._container.get_abs_pos()
+                self.abs_pos = (self.pos[0] + container_pos[0], self.pos[1] + container_pos[1])
+            self.dirty = False
         return self.abs_pos
 
 
 class Container(Node):
+    """
+    With set_layered(True), the container's background and its static children
+    are composed once into an offscreen layer. Each frame draws that layer with one
+    blit and then only the dynamic children on top of it. The layer is rebuilt when
+    a static child invalidates.
+    """
+
     def __init__(self):
         Node.__init__(self)
         self.children = list(())
+        self.layered = False
+        self.layer = None
+        self.layer_offset = (0, 0)
+        self.layer_dirty = True
 
-    def add_object(self, child):
+    def add_object(self, child, static=False):
         self.children.append(child)
+        child.static = static
         child.container = self
+        if static:
+            self.layer_dirty = True
 
     def remove_object(self, child):
+        child.invalidate()
         self.children.remove(child)
         child.container = None
 
-    def event(self, event):
+    def set_layered(self, layered):
+        self.layered = layered
+        self.layer = None
+        self.layer_dirty = True
+        self.invalidate()
+
+    def release(self):
+        Node.release(self)
+        self.layer = None
+        for child in self.children:
+            child.release()
+
+    def dirty_subtree(self):
+        for child in self.children:
+            if not child.dirty:
+                child.dirty_subtree()
+        self.dirty = True
+
+    def layout(self, container_pos):
+        Node.layout(self, container_pos)
+        for child in self.children:
+            child.layout(self.abs_pos)
+
+    def get_rect(self):
+        rect = Node.get_rect(self)
         for child in self.children:
-            child.event(event)
+            child_rect = child.get_rect()
+            if child_rect.width <= 0 or child_rect.height <= 0:
+                continue
+            if rect.width > 0 and rect.height > 0:
+                rect.union_ip(child_rect)
+            else:
+                rect = child_rect
+        return rect
+
+    def event(self, event):
+        # Children that want input subscribe to input_dispatcher
+        pass
 
     def update(self):
         for child in self.children:
             child.update()
 
-    def render(self, screen):
+    def render_background(self, screen):
+        pass
+
+    def build_layer(self):
+        rect = pygame.Rect(self.get_abs_pos(), self.get_size())
+        for child in self.children:
+            if child.static:
+                child_rect = child.get_rect()
+                if child_rect.width > 0 and child_rect.height > 0:
+                    rect = rect.union(child_rect) if rect.width > 0 and rect.height > 0 else child_rect
+        self.layer = None
+        self.layer_dirty = False
+        if rect.width <= 0 or rect.height <= 0:
+            return
+        self.layer = pygame.Surface(rect.size, pygame.SRCALPHA, 32)
+        self.layer.fill((0, 0, 0, 0))
+        target = LayerTarget(self.layer, rect.topleft)
+        self.render_background(target)
         for child in self.children:
-            child.render(screen)
+            if child.static:
+                child.render(target)
+        self.layer_offset = (rect.x - self.abs_pos[0], rect.y - self.abs_pos[1])
 
-    def position(self, x, y):
-        Node.position(self, x, y)
+    def render(self, screen):
+        if not self.layered:
+            self.render_background(screen)
+            for child in self.children:
+                child.render(screen)
+            return
+
+        if self.layer_dirty:
+            self.build_layer()
+        if self.layer is not None:
+            pos = self.get_abs_pos()
+            screen.blit(self.layer, (pos[0] + self.layer_offset[0], pos[1] + self.layer_offset[1]))
+        for child in self.children:
+            if not child.static:
+                child.render(screen)
 
 
 class Panel(Container):
     def __init__(self, path, width, height):
         Container.__init__(self)
-        with open(path) as file:
-            data = json.load(file)
-            slices = data["slice"]
-            image = pygame.image.load(data["image"]).convert_alpha()
-            self.image = SliceSprite(image, slicing=(slices["l"], slices["r"], slices["t"], slices["b"]))
+        data = self.acquire(assets.descriptor(path))
+        slices = data["slice"]
+        image = self.acquire(assets.image(data["image"]))
+        self.image = SliceSprite(image, slicing=(slices["l"], slices["r"], slices["t"], slices["b"]))
         self.width = width
         self.height = height
         self.image.set_rect((0, 0, self.width, self.height))
@@ -86,26 +445,20 @@ class Panel(Container):
     def event(self, event):
         Container.event(self, event)
 
-    def update(self):
-        Container.update(self)
-        if self.dirty:
-            self.position(self.pos[0], self.pos[1])
-
-    def render(self, screen):
+    def render_background(self, screen):
         if self.image is not None:
             self.image.render(screen)
-        Container.render(self, screen)
 
-    def position(self, x, y):
-        Container.position(self, x, y)
-        pos = self.get_abs_pos()
-        self.image.set_rect((pos[0], pos[1], self.width, self.height))
-        self.dirty = False
+    def on_layout(self):
+        self.image.set_rect((self.abs_pos[0], self.abs_pos[1], self.width, self.height))
+
+    def get_size(self):
+        return self.width, self.height
 
 
 class Image:
     def __init__(self, path):
-        self.image = pygame.image.load(path)
+        self.image = assets.image(path, alpha=False)
         self.pos = (0, 0)
 
     def event(self, event):
@@ -136,6 +489,7 @@ class Label(Node):
     def update(self):
         if self.cached_image is None:
             self.cached_image = self.font.render(self.text, True, self.color)
+            self.invalidate()
 
     def render(self, screen):
         if self.cached_image is not None:
@@ -144,13 +498,93 @@ class Label(Node):
     def position(self, x, y):
         Node.position(self, x, y)
 
+    def get_size(self):
+        if self.cached_image is None:
+            return 0, 0
+        return self.cached_image.get_size()
+
     def set_text(self, text):
+        if text == self.text and self.cached_image is not None:
+            return
+        self.invalidate()
         self.text = text
         self.cached_image = None
         self.update()
 
 
+class NumberLabel(Node):
+    """
+    A fixed prefix followed by an integer, e.g. "Ammo: 30". Digits sit in fixed
+    width cells of the label's own surface, so set_value only clears and blits the
+    cells whose digit changed and invalidates just those.
+    """
+
+    def __init__(self, font, prefix, value=0, color=(0, 0, 0), digits=3):
+        Node.__init__(self)
+        self.glyphs = self.acquire(glyph_cache(font, color))
+        self.prefix = prefix
+        self.prefix_image = font.render(prefix, True, color)
+        self.value = None
+        self.text = ''
+        self.prefix_width = self.prefix_image.get_width()
+        self.cell = max(self.glyphs.glyph(digit).get_width() for digit in '-0123456789')
+        self.digits = digits
+        self.cached_image = self.build()
+        self.set_value(value)
+
+    def build(self):
+        surface = pygame.Surface((self.prefix_width + self.digits * self.cell, self.glyphs.height), pygame.SRCALPHA, 32)
+        surface.fill((0, 0, 0, 0))
+        surface.blit(self.prefix_image, (0, 0))
+        return surface
+
+    def event(self, event):
+        pass
+
+    def update(self):
+        pass
+
+    def render(self, screen):
+        screen.blit(self.cached_image, self.get_abs_pos())
+
+    def get_size(self):
+        return self.cached_image.get_size()
+
+    def set_value(self, value):
+        if value == self.value:
+            return
+        self.value = value
+        text = str(value)
+        old = self.text
+        if len(text) > self.digits:
+            # Grow to fit and redraw everything
+            self.invalidate()
+            self.digits = len(text)
+            self.cached_image = self.build()
+            old = ''
+        pos = self.get_abs_pos()
+        for i in range(max(len(text), len(old))):
+            char = text[i] if i < len(text) else None
+            if i < len(old) and char == old[i]:
+                continue
+            cell = pygame.Rect(self.prefix_width + i * self.cell, 0, self.cell, self.glyphs.height)
+            self.cached_image.fill((0, 0, 0, 0), cell)
+            if char is not None:
+                glyph = self.glyphs.glyph(char)
+                self.cached_image.blit(glyph, (cell.x + (self.cell - glyph.get_width()) // 2, 0))
+            self.invalidate_rect(cell.move(pos))
+        self.text = text
+
+
 class Bar(Node):
+    """
+    The background and a full-width foreground are built once. A partial fill is
+    the foreground blitted with a clipped source rect plus the right cap, so
+    set_percent never scales anything. With a duration, set_percent tweens the
+    shown fill towards the new value over that many seconds, stepped by a timer so
+    the idle main loop keeps waking until the tween ends.
+    """
+    tween_interval = 1.0 / 30
     left_fore = None
     mid_fore = None
     right_fore = None
@@ -162,45 +596,72 @@ class Bar(Node):
         Node.__init__(self)
         self.pos = (0, 0)
         self.percent = 1.0
+        self.shown = 1.0
         self.width = width
-        self.mid_fg = None
-        self.mid_bg = None
-        self.fore_sizes = (0, 0, 0)
-        self.back_sizes = (0, 0, 0)
-
-        with open(path) as f:
-            data = json.load(f)
-            self.left_fore = pygame.image.load(data["left_fore"]).convert_alpha()
-            self.right_fore = pygame.image.load(data["right_fore"]).convert_alpha()
-            self.mid_fg = pygame.image.load(data["mid_fore"]).convert_alpha()
-
-            self.left_back = pygame.image.load(data["left_back"]).convert_alpha()
-            self.right_back = pygame.image.load(data["right_back"]).convert_alpha()
-            self.mid_bg = pygame.image.load(data["mid_back"]).convert_alpha()
-            self.update_bar()
-
-    def set_percent(self, percent):
+        self.tween = None
+        self.tween_timer = None
+        self.background = None
+        self.foreground = None
+
+        data = self.acquire(assets.descriptor(path))
+        self.left_fore = self.acquire(assets.image(data["left_fore"]))
+        self.right_fore = self.acquire(assets.image(data["right_fore"]))
+        self.mid_fore = self.acquire(assets.image(data["mid_fore"]))
+
+        self.left_back = self.acquire(assets.image(data["left_back"]))
+        self.right_back = self.acquire(assets.image(data["right_back"]))
+        self.mid_back = self.acquire(assets.image(data["mid_back"]))
+        self.background = self.build(self.left_back, self.mid_back, self.right_back)
+        # The foreground's right cap is drawn at the fill end in render()
+        self.foreground = self.build(self.left_fore, self.mid_fore, self.right_fore, False)
+
+    def build(self, left, mid, right, draw_right=True):
+        lw = left.get_width()
+        rw = right.get_width()
+        mw = self.width - lw - rw
+        surface = pygame.Surface((self.width, left.get_height()), pygame.SRCALPHA, 32)
+        surface.fill((0, 0, 0, 0))
+        surface.blit(left, (0, 0))
+        if mw > 0:
+            surface.blit(pygame.transform.smoothscale(mid, (mw, mid.get_height())), (lw, 0))
+        if draw_right:
+            surface.blit(right, (self.width - rw, 0))
+        return surface
+
+    def set_percent(self, percent, duration=0.0):
         self.percent = percent
-        self.update_bar()
+        self.stop_tween()
+        if duration > 0:
+            self.tween = (self.shown, time.time(), duration)
+            self.tween_timer = timers.call_every(self.tween_interval, self.step)
+        else:
+            self.show(percent)
 
-    def update_bar(self):
+    def stop_tween(self):
+        self.tween = None
+        if self.tween_timer is not None:
+            self.tween_timer.cancel()
+            self.tween_timer = None
+
+    def fill_width(self, percent):
         lw = self.left_fore.get_width()
         rw = self.right_fore.get_width()
-        mw = int((self.width - lw - rw) * self.percent)
-        if mw > 0:
-            self.fore_sizes = (lw, mw, rw)
-            self.mid_fore = pygame.transform.smoothscale(self.mid_fg, (mw, self.mid_fg.get_height()))
-        else:
-            self.fore_sizes = (lw, 0, rw)
-
-        lbw = self.left_back.get_width()
-        rbw = self.right_back.get_width()
-        mbw = (self.width - lbw - rbw)
-        if mbw > 0:
-            self.back_sizes = (lbw, mbw, rbw)
-            self.mid_back = pygame.transform.smoothscale(self.mid_bg, (mbw, self.mid_bg.get_height()))
-        else:
-            self.back_sizes = (lbw, 0, rbw)
+        return lw + max(int((self.width - lw - rw) * percent), 0)
+
+    def show(self, percent):
+        # Only the span between the old and new fill ends changes, including the right cap
+        old = self.fill_width(self.shown) if self.shown > 0 else 0
+        new = self.fill_width(percent) if percent > 0 else 0
+        self.shown = percent
+        if old == new:
+            return
+        pos = self.get_abs_pos()
+        left = min(old, new)
+        right = max(old, new) + self.right_fore.get_width()
+        self.invalidate_rect(pygame.Rect(pos[0] + left, pos[1], right - left, self.get_size()[1]))
+
+    def get_size(self):
+        return self.width, self.left_back.get_height()
 
     def event(self, event):
         pass
@@ -211,24 +672,29 @@ class Bar(Node):
     def update(self):
         pass
 
+    def step(self):
+        start, started, duration = self.tween
+        t = (time.time() - started) / duration
+        if t >= 1.0:
+            self.stop_tween()
+            self.show(self.percent)
+        else:
+            self.show(self.lerp(start, self.percent, t))
+
+    def release(self):
+        self.stop_tween()
+        Node.release(self)
+
     def render(self, screen):
         pos = self.get_abs_pos()
-        if self.left_back is not None:
-            screen.blit(self.left_back, pos)
-        if self.mid_back is not None and self.back_sizes[1] > 0:
-            screen.blit(self.mid_back, (pos[0] + self.back_sizes[0], pos[1]))
-        if self.right_back is not None:
-            screen.blit(self.right_back, (pos[0] + self.back_sizes[0] + self.back_sizes[1], pos[1]))
-
-        if self.percent <= 0:
+        screen.blit(self.background, pos)
+
+        if self.shown <= 0:
             return
 
-        if self.left_fore is not None:
-            screen.blit(self.left_fore, pos)
-        if self.mid_fore is not None and self.fore_sizes[1] > 0:
-            screen.blit(self.mid_fore, (pos[0] + self.fore_sizes[0], pos[1]))
-        if self.right_fore is not None:
-            screen.blit(self.right_fore, (pos[0] + self.fore_sizes[0] + self.fore_sizes[1], pos[1]))
+        fill = self.fill_width(self.shown)
+        screen.blit(self.foreground, pos, (0, 0, fill, self.foreground.get_height()))
+        screen.blit(self.right_fore, (pos[0] + fill, pos[1]))
 
 
 class Button(Container):
@@ -240,11 +706,10 @@ class Button(Container):
 
     def __init__(self, path, width, height, font, label="Button", label_color=(255, 255, 255)):
         Container.__init__(self)
-        with open(path) as f:
-            data = json.load(f)
-            slices = data["slice"]
-            image = pygame.image.load(data["image"]).convert_alpha()
-            self.image = SliceSprite(image, slicing=(slices["l"], slices["r"], slices["t"], slices["b"]))
+        data = self.acquire(assets.descriptor(path))
+        slices = data["slice"]
+        image = self.acquire(assets.image(data["image"]))
+        self.image = SliceSprite(image, slicing=(slices["l"], slices["r"], slices["t"], slices["b"]))
         self.pos = (0, 0)
         self.width = width
         self.height = height
@@ -253,43 +718,22 @@ class Button(Container):
         self.label = Label(font, label, label_color)
         self.add_object(self.label)
         self.label.position(10, 8)
+        input_dispatcher.subscribe(self, (pygame.MOUSEBUTTONDOWN,))
 
     def set_callback(self, callback):
         self.callback = callback
 
     def event(self, event):
-        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-            mouse = pygame.mouse.get_pos()
-            if self.pressed(mouse):
-                if self.callback is not None:
-                    self.callback()
+        # Only called by input_dispatcher for presses inside the button
+        if event.button == 1 and self.callback is not None:
+            self.callback()
 
-    def update(self):
-        Container.update(self)
-        if self.dirty:
-            pos = self.get_abs_pos()
-            self.image.set_rect((pos[0], pos[1], self.width, self.height))
-            self.dirty = False
+    def on_layout(self):
+        self.image.set_rect((self.abs_pos[0], self.abs_pos[1], self.width, self.height))
 
-    def render(self, screen):
+    def render_background(self, screen):
         if self.image is not None:
             self.image.render(screen)
-        Container.render(self, screen)
-
-    def pressed(self, mouse):
-        x, y, w, h = self.image.get_rect()
-        rect = pygame.Rect(x, y, w, h)
-        if mouse[0] > rect.topleft[0]:
-            if mouse[1] > rect.topleft[1]:
-                if mouse[0] < rect.bottomright[0]:
-                    if mouse[1] < rect.bottomright[1]:
-                        return True
-                    else: return False
-                else: return False
-            else: return False
-        else: return False
 
-    def position(self, x, y):
-        Container.position(self, x, y)
-        pos = self.get_abs_pos()
-        self.image.set_rect((pos[0], pos[1], self.width, self.height))
+    def get_size(self):
+        return self.width, self.height
@@ -0,0 +1,147 @@
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Leveled logging that never writes or flushes on the calling thread.
+# Records go into a bounded ring buffer with their format arguments, and a background
+# thread formats and writes them in batches, so the BLE and render threads only pay
+# for a deque append:
+#
+#   log.debug("Ammo: %d", ammo)
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARN', ERROR: 'ERROR'}
+
+
+class AsyncLog:
+    """
+    Writes to stdout until open() is called with a file, which is then rotated by size:
+    log.txt becomes log.txt.1 and so on, keeping `backups` old files. When the buffer
+    is full the oldest records are dropped rather than blocking the caller.
+    """
+    flush_interval = 0.5
+
+    def __init__(self, capacity=2048):
+        self.level = INFO
+        self.records = deque(maxlen=capacity)
+        self.dropped = 0
+        self.stream = sys.stdout
+        self.path = None
+        self.max_bytes = 0
+        self.backups = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = True
+        # Started here rather than on first use, so two threads logging at once can't both start one
+        self.writer = threading.Thread(target=self.run, name='log-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def open(self, path, max_bytes=1024 * 1024, backups=3):
+        with self.lock:
+            self.path = path
+            self.max_bytes = max_bytes
+            self.backups = backups
+            self.stream = open(path, 'a')
+            self.size = self.stream.tell()
+
+    def log(self, level, message, args):
+        if level < self.level:
+            return
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), level, message, args))
+        if level >= ERROR:
+            self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        # Stops the writer at exit, a daemon thread still running while the interpreter
+        # tears down its modules fails in whatever it calls next
+        self.running = False
+        self.wake.set()
+        self.writer.join()
+        self.flush()
+
+    def format(self, record):
+        stamp, level, message, args = record
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = "%s %r" % (message, args)
+        return "%s.%03d %-5s %s\n" % (time.strftime('%H:%M:%S', time.localtime(stamp)),
+                                      int(stamp * 1000) % 1000, level_names.get(level, level), message)
+
+    def flush(self):
+        with self.lock:
+            lines = list(())
+            while True:
+                try:
+                    lines.append(self.format(self.records.popleft()))
+                except IndexError:
+                    break
+            if self.dropped > 0:
+                lines.append("%d log records dropped\n" % self.dropped)
+                self.dropped = 0
+            if not lines:
+                return
+
+            data = ''.join(lines)
+            self.stream.write(data)
+            self.stream.flush()
+            self.size += len(data)
+            if self.path is not None and 0 < self.max_bytes <= self.size:
+                self.rotate()
+
+    def rotate(self):
+        self.stream.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, index)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, index + 1))
+        if self.backups > 0:
+            os.rename(self.path, "%s.1" % self.path)
+        self.stream = open(self.path, 'w')
+        self.size = 0
+
+
+_log = AsyncLog()
+atexit.register(_log.close)
+
+
+def open_file(path, max_bytes=1024 * 1024, backups=3):
+    _log.open(path, max_bytes, backups)
+
+
+def set_level(level):
+    _log.level = level
+
+
+def debug(message, *args):
+    _log.log(DEBUG, message, args)
+
+
+def info(message, *args):
+    _log.log(INFO, message, args)
+
+
+def warning(message, *args):
+    _log.log(WARNING, message, args)
+
+
+def error(message, *args):
+    _log.log(ERROR, message, args)
@@ -1,14 +1,19 @@
+import os
+import sys
 import pygame
 import pygame.display
 import pygame.mixer
 import tagmsg
+import assets
+import audio
 from pygame.locals import *
 from app import *
 from gui import *
 from screen import *
 from tagger import *
-from utils import print_console
-from blinker import signal
+import tagger
+from eventbus import Subscriptions
+import log
 
 
 class TestScreen(Screen):
@@ -20,7 +25,9 @@ class TestScreen(Screen):
     health = 30.0
     max_health = 30.0
     tagger = None
-    sound = None
+    fire_sound = None
+    subscriptions = None
+    font = None
     ammo_changed = None
 
     def __init__(self, root):
@@ -28,13 +35,16 @@ class TestScreen(Screen):
         self.root = root
 
     def enter(self):
-        print_console("Entering test screen")
-        self.sound = pygame.mixer.Sound('fire.mp3')
+        log.info("Entering test screen")
+        # Played from the BLE worker thread as the trigger notification arrives
+        self.fire_sound = audio.engine.bind(tagmsg.on_trigger, 'fire')
         size = (320, 240)
         app_size = self.root.size
         title_color = (146, 218, 249)
         label_color = (145, 152, 162)
         panel = Panel('ui/PNG/metalPanel_blueCorner.slc', size[0], size[1])
+        # Background, title and captions are drawn once into the panel's layer
+        panel.set_layered(True)
         panel.position((app_size[0] / 2) - (size[0] / 2), (app_size[1] / 2) - (size[1] / 2))
         self.main_panel = panel
         self.root.add_object(self.main_panel)
@@ -44,15 +54,16 @@ class TestScreen(Screen):
         label_offset = 7
         padding = 10
         right_offset = 100
-        font = pygame.font.Font("ui/Fonts/kenvector_future.ttf", 12)
+        font = assets.font("ui/Fonts/kenvector_future.ttf", 12)
+        self.font = font
         title = Label(font, "PyCoil", title_color)
         title.position(padding, 8)
-        panel.add_object(title)
+        panel.add_object(title, static=True)
 
         bar_width = size[0] - padding - right_offset
         label = Label(font, "Shield", label_color)
         label.position(padding, y_offset + label_offset)
-        panel.add_object(label)
+        panel.add_object(label, static=True)
         self.shield_bar = Bar('ui/blue_horizontal.bar', bar_width)
         self.shield_bar.position(right_offset, y_offset)
         panel.add_object(self.shield_bar)
@@ -60,7 +71,7 @@ class TestScreen(Screen):
 
         label = Label(font, "Health", label_color)
         label.position(padding, y_offset + label_offset)
-        panel.add_object(label)
+        panel.add_object(label, static=True)
         self.health_bar = Bar('ui/red_horizontal.bar', bar_width)
         self.health_bar.position(right_offset, y_offset)
         panel.add_object(self.health_bar)
@@ -77,23 +88,23 @@ class TestScreen(Screen):
         panel.add_object(self.msg_label)
         y_offset += height_offset
 
-        self.ammo_label = Label(font, "Ammo: 0", label_color)
+        self.ammo_label = NumberLabel(font, "Ammo: ", 0, label_color)
         self.ammo_label.position(padding, y_offset + label_offset)
         panel.add_object(self.ammo_label)
 
-        tagmsg.on_ammo_changed.connect(self.ammo_changed)
-        tagmsg.on_message.connect(self.message)
+        # Only the latest value per frame reaches the labels
+        self.subscriptions = Subscriptions()
+        self.subscriptions.connect(tagmsg.on_ammo_changed, self.ammo_changed, batched=True)
+        self.subscriptions.connect(tagmsg.on_message, self.message, batched=True)
 
         self.tagger = TaggerService()
         self.tagger.try_connect()
 
-    def message(self, sender, **kw):
-        if 'msg' in kw:
-            self.msg_label.set_text("Message: %s" % kw['msg'])
+    def message(self, sender, msg):
+        self.msg_label.set_text("Message: %s" % msg)
 
-    def ammo_changed(self, sender, **kw):
-        if 'ammo' in kw:
-            self.ammo_label.set_text("Ammo: %d" % int(kw['ammo']))
+    def ammo_changed(self, sender, ammo):
+        self.ammo_label.set_value(int(ammo))
 
     def update(self):
         Screen.update(self)
@@ -103,10 +114,15 @@ class TestScreen(Screen):
     def button_press(self):
         self.health -= 1.0
         self.health_bar.set_percent(self.health / self.max_health)
-        self.sound.play()
+        audio.engine.play('fire')
 
     def exit(self):
         self.root.remove_object(self.main_panel)
+        self.main_panel.release()
+        assets.release(self.font)
+        audio.engine.unbind(tagmsg.on_trigger, self.fire_sound)
+        self.subscriptions.release()
+        self.tagger.stop()
 
 
 class PycoilApp(App):
@@ -117,6 +133,10 @@ class PycoilApp(App):
         App.__init__(self)
 
     def setup(self):
+        # Packed by atlas.py, the loose PNGs are used when it hasn't been built
+        if os.path.exists('ui/atlas.json'):
+            assets.load_atlas('ui/atlas.json')
+        audio.engine.load('fire', 'fire.mp3')
         self.screen_manager = ScreenManager()
         self.main_screen = TestScreen(self)
         self.screen_manager.add_screen(self.main_screen)
@@ -124,8 +144,13 @@ class PycoilApp(App):
         self.add_object(self.screen_manager)
 
 
+log.open_file('log.txt')
+if '--no-record' in sys.argv:
+    tagger.record_telemetry_path = None
+audio.engine.init()
 app = PycoilApp()
 app.init_display()
 app.set_bg_color((63, 124, 182))
 app.setup()
 app.run()
+audio.engine.close()
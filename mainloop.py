@@ -0,0 +1,186 @@
+import heapq
+import thread
+import time
+from collections import deque
+
+# Lets other threads wake the main loop when App.run is idle and blocked waiting
+# for events, runs calls on the thread that owns the state they touch, and
+# schedules timers on the main loop instead of a thread per timer.
+# This module has no pygame dependency so the BLE code can use it.
+
+
+class Waker:
+    """
+    wake() is cheap enough to call for every telemetry frame: after the first call
+    it is an attribute check until the main loop clears it at the top of a frame.
+    Calls from the main thread are ignored since the loop is awake by definition.
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.pending = False
+        self.sleeping = False
+        self.main_ident = thread.get_ident()
+
+    def set_handler(self, handler):
+        # handler interrupts the main loop's blocking wait, it is called from other threads
+        self.handler = handler
+        self.main_ident = thread.get_ident()
+        main.bind()
+
+    def wake(self):
+        if self.pending or thread.get_ident() == self.main_ident:
+            return
+        self.pending = True
+        if self.sleeping and self.handler is not None:
+            self.handler()
+
+    def clear(self):
+        self.pending = False
+
+
+waker = Waker()
+
+
+class Context:
+    """
+    A thread that handlers can be bound to. call() from the owning thread runs the
+    function right away; from any other thread it is queued, and the owner runs it
+    the next time it calls drain(). The main context is drained once per frame by
+    App.run (hosts without an App call main.drain() in their loop), a tagger's I/O
+    context by its BLE worker between waits.
+    """
+
+    def __init__(self, name, waker=None, ident=None):
+        self.name = name
+        self.waker = waker
+        self.ident = ident
+        self.calls = deque()
+
+    def bind(self):
+        # The calling thread owns this context from now on
+        self.ident = thread.get_ident()
+
+    def call(self, function, *args):
+        if thread.get_ident() == self.ident:
+            function(*args)
+            return
+        self.calls.append((function, args))
+        if self.waker is not None:
+            self.waker.wake()
+
+    def drain(self):
+        # Calls queued while draining wait for the next drain
+        for i in range(len(self.calls)):
+            function, args = self.calls.popleft()
+            function(*args)
+
+    def handler(self, function):
+        return ContextHandler(function, self)
+
+
+class ContextHandler(object):
+    """Event handler that runs `function` in `context`, compares equal to `function` for disconnect."""
+    __slots__ = ('function', 'context')
+
+    def __init__(self, function, context):
+        self.function = function
+        self.context = context
+
+    def __call__(self, *args):
+        self.context.call(self.function, *args)
+
+    def __eq__(self, other):
+        if isinstance(other, ContextHandler):
+            return self.function == other.function and self.context is other.context
+        return self.function == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.function)
+
+
+class TimerHandle(object):
+    __slots__ = ('deadline', 'interval', 'function', 'args', 'cancelled')
+
+    def __init__(self, deadline, interval, function, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # The heap entry stays until it comes due and is then skipped
+        self.cancelled = True
+        self.function = None
+        self.args = None
+
+    @property
+    def active(self):
+        return not self.cancelled
+
+
+class Scheduler:
+    """
+    Timers run by whichever loop calls run_due(): App.run for the main `timers`.
+    A heap ordered by deadline, so scheduling and running are O(log n) and an idle
+    loop can sleep exactly until next_delay(). Not thread safe: other threads
+    schedule through the owning loop's context, e.g. main.call(timers.call_later, ...).
+    `clock` can be replaced to drive timers by hand.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = list(())
+        self.count = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def call_later(self, delay, function, *args):
+        return self.push(TimerHandle(self.clock() + delay, None, function, args))
+
+    def call_every(self, interval, function, *args):
+        return self.push(TimerHandle(self.clock() + interval, interval, function, args))
+
+    def push(self, handle):
+        # The count keeps timers with the same deadline in scheduling order
+        self.count += 1
+        heapq.heappush(self.heap, (handle.deadline, self.count, handle))
+        return handle
+
+    def next_delay(self):
+        # Seconds until the next live timer, or None when there are none
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(heap[0][0] - self.clock(), 0.0)
+
+    def due(self):
+        return self.next_delay() == 0.0
+
+    def run_due(self):
+        now = self.clock()
+        heap = self.heap
+        # Bounded, so a repeating timer that fell behind can't keep this loop going
+        for i in range(len(heap)):
+            if not heap or heap[0][0] > now:
+                break
+            handle = heapq.heappop(heap)[2]
+            if handle.cancelled:
+                continue
+            if handle.interval is None:
+                handle.cancelled = True
+            else:
+                handle.deadline += handle.interval
+                self.push(handle)
+            handle.function(*handle.args)
+
+
+main = Context('main', waker, thread.get_ident())
+timers = Scheduler()
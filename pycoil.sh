@@ -1,2 +1,3 @@
 #!/usr/bin/env bash
-sudo python main.py > log.txt
\ No newline at end of file
+# main.py writes its own rotating log.txt
+sudo python main.py
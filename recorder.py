@@ -0,0 +1,201 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from utils import print_console
+
+# Raw telemetry capture. A log is a header followed by fixed size records, each the
+# arrival time of a notification and its 20 raw bytes, so any frame can be read
+# straight out of a memory map by index.
+#
+#   python recorder.py info telemetry.rec
+#   python recorder.py replay telemetry.rec [speed]     speed 0 replays at max speed
+
+MAGIC = b'RCLG'
+VERSION = 1
+header_struct = struct.Struct('<4sHH')
+record_struct = struct.Struct('<d20s')
+
+
+class TelemetryRecorder:
+    """
+    Appends every telemetry frame sent on a signal to a log file. record() only queues
+    the packed frame and a writer thread does the file writes, so capture never touches
+    the SD card from the main loop. When the file reaches `max_bytes` it is rotated like
+    the app log, keeping `backups` old captures. If the writer falls behind the oldest
+    frames are dropped.
+    """
+    buffer_size = 64 * 1024
+    flush_interval = 0.5
+
+    def __init__(self, path, max_bytes=16 * 1024 * 1024, backups=2, capacity=8192):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.count = 0
+        self.dropped = 0
+        self.size = 0
+        self.signals = None
+        self.file = None
+        self.records = deque(maxlen=capacity)
+        self.wake = threading.Event()
+        self.running = True
+        self.writer = threading.Thread(target=self.run, name='telemetry-writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def attach(self, signals):
+        self.signals = signals
+        signals.on_telemetry_data.connect(self.record)
+
+    def detach(self):
+        if self.signals is not None:
+            self.signals.on_telemetry_data.disconnect(self.record)
+            self.signals = None
+
+    def record(self, sender, data, stamp):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append(record_struct.pack(stamp, data))
+        self.count += 1
+
+    def run(self):
+        self.open_file()
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+        self.flush()
+        self.file.close()
+        self.file = None
+
+    def open_file(self):
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.file = open(self.path, 'ab', self.buffer_size)
+        if new_file:
+            self.file.write(header_struct.pack(MAGIC, VERSION, record_struct.size))
+        self.size = os.path.getsize(self.path) if not new_file else header_struct.size
+
+    def flush(self):
+        records = list(())
+        while True:
+            try:
+                records.append(self.records.popleft())
+            except IndexError:
+                break
+        if not records:
+            return
+        data = b''.join(records)
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        if 0 < self.max_bytes <= self.size:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            older = "%s.%d" % (self.path, index)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.path, index + 1))
+        if self.backups > 0:
+            os.rename(self.path, "%s.1" % self.path)
+        else:
+            os.remove(self.path)
+        self.open_file()
+
+    def close(self):
+        self.detach()
+        if self.writer is not None:
+            self.running = False
+            self.wake.set()
+            self.writer.join()
+            self.writer = None
+
+
+class TelemetryReplay:
+    """
+    Memory maps a telemetry log for playback. Frames are read in place, so opening
+    and seeking a long capture costs nothing up front.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = None
+        self.count = 0
+        length = os.fstat(self.file.fileno()).st_size
+        if length == 0:
+            # Created by a recorder that hasn't written anything yet, mmap refuses empty files
+            return
+        if length < header_struct.size:
+            self.close()
+            raise ValueError("%s is not a telemetry log" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = header_struct.unpack_from(self.map, 0)
+        if magic != MAGIC or size != record_struct.size:
+            self.close()
+            raise ValueError("%s is not a telemetry log" % path)
+        self.count = (len(self.map) - header_struct.size) // record_struct.size
+
+    def __len__(self):
+        return self.count
+
+    def frame(self, index):
+        return record_struct.unpack_from(self.map, header_struct.size + index * record_struct.size)
+
+    def frames(self):
+        # Raw frames only, e.g. to feed a simtagger.SimTagger
+        for index in range(self.count):
+            yield self.frame(index)[1]
+
+    def duration(self):
+        if self.count < 2:
+            return 0.0
+        return self.frame(self.count - 1)[0] - self.frame(0)[0]
+
+    def play(self, signal, sender=None, speed=1.0):
+        """
+        Sends every frame on `signal` as on_telemetry_data would.
+        speed 1.0 keeps the recorded timing, 0 sends as fast as possible.
+        """
+        if self.count == 0:
+            return
+        first = self.frame(0)[0]
+        start = time.time()
+        for index in range(self.count):
+            stamp, data = self.frame(index)
+            if speed > 0:
+                wait = (stamp - first) / speed - (time.time() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            signal.send(sender, data, stamp)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ('info', 'replay'):
+        print_console("usage: python recorder.py info|replay <file> [speed]")
+        sys.exit(1)
+
+    replay = TelemetryReplay(sys.argv[2])
+    print_console("%d frames over %.1f seconds" % (len(replay), replay.duration()))
+    if sys.argv[1] == 'replay':
+        import tagger
+        import tagmsg
+        speed = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+        target = tagger.Tagger(None, None)
+        start = time.time()
+        replay.play(tagmsg.on_telemetry_data, speed=speed)
+        elapsed = time.time() - start
+        print_console("Replayed %d frames in %.2f seconds, %.0f frames/sec"
+                      % (target.telemetry_count, elapsed, target.telemetry_count / max(elapsed, 0.000001)))
+    replay.close()
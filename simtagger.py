@@ -0,0 +1,469 @@
+import sys
+import threading
+import time
+import types
+from telemetry import *
+
+# Simulated Recoil taggers, for exercising DataDelegate, Tagger.read_telemetry and
+# TelemetryService on a box with no Bluetooth adapter. Call install() before creating
+# a TaggerService or TaggerPool, then add SimTagger devices:
+#
+#   simtagger.install()
+#   sim = simtagger.add_device(SimTagger('00:00:00:00:00:01', rate=2000.0))
+#   sim.pull_trigger()
+
+try:
+    from bluepy.btle import BTLEException, BTLEDisconnectError
+except ImportError:
+    class BTLEException(Exception):
+        def __init__(self, message, resp_dict=None):
+            Exception.__init__(self, message)
+            self.message = message
+
+    class BTLEDisconnectError(BTLEException):
+        pass
+
+ID_HANDLE = 0x0B
+TELEMETRY_HANDLE = 0x0E
+CCCD_HANDLE = 0x0F
+COMMAND_HANDLE = 0x11
+CONFIG_HANDLE = 0x14
+CHARACTERISTIC_DECLARATION = "00002803-0000-1000-8000-00805f9b34fb"
+
+devices = dict()
+
+
+def add_device(sim):
+    devices[sim.addr] = sim
+    return sim
+
+
+def remove_device(addr):
+    devices.pop(addr, None)
+
+
+class SimTagger:
+    """
+    State of one simulated tagger. Telemetry frames are synthesized from the current
+    state at `rate` frames per second, or replayed from `frames` (20 byte strings)
+    when given. Every command written to the tagger is recorded in `writes`.
+    Each GATT request made to a connected peripheral takes `round_trip` seconds, and
+    `handle_offset` moves every attribute handle, like a firmware update would.
+    """
+    round_trip = 0.0
+    handle_offset = 0
+
+    def __init__(self, addr, tagger_type=TYPE_RIFLE, player_id=1, ammo=30, rate=20.0, frames=None):
+        self.addr = addr
+        self.name = 'SRG1-SIM'
+        self.rssi = -60
+        self.tagger_type = tagger_type
+        self.rate = rate
+        self.replay = None
+        if frames is not None:
+            self.replay = iter(frames)
+        self.lock = threading.Lock()
+        self.data = bytearray(FRAME_SIZE)
+        self.data[1] = player_id
+        self.data[7] = 100
+        self.data[14] = ammo
+        self.ir_counter = 0
+        self.writes = list(())
+        self.dropped = False
+
+    def frame(self):
+        if self.replay is not None:
+            return next(self.replay, None)
+        with self.lock:
+            return bytes(self.data)
+
+    def id_data(self):
+        data = [0x00] * FRAME_SIZE
+        data[10] = self.tagger_type
+        return frame_struct.pack(*data)
+
+    def bump(self, index, mask):
+        # Button counters are nibbles that wrap
+        shift = 4 if mask == 0xf0 else 0
+        value = ((self.data[index] & mask) >> shift) + 1
+        self.data[index] = (self.data[index] & ~mask & 0xff) | ((value << shift) & mask)
+
+    def pull_trigger(self):
+        with self.lock:
+            self.bump(3, 0x0f)
+            if self.data[14] > 0:
+                self.data[14] -= 1
+
+    def press_reload(self):
+        with self.lock:
+            self.bump(3, 0xf0)
+
+    def press_back(self):
+        with self.lock:
+            self.bump(4, 0x0f)
+
+    def press_power(self):
+        with self.lock:
+            self.bump(5, 0x0f)
+
+    def ir_hit(self, payload, sensor=1):
+        with self.lock:
+            self.ir_counter = (self.ir_counter % 0xF) + 1
+            self.data[8] = payload & 0xff
+            self.data[9] = (payload >> 8) & 0xff
+            self.data[10] = ((sensor & 0xF) << 4) | self.ir_counter
+
+    def set_battery(self, level):
+        with self.lock:
+            self.data[7] = level
+
+    def drop(self):
+        # The next poll of a connected peripheral fails like a lost link
+        self.dropped = True
+
+    def command(self, handle, data):
+        self.writes.append((time.time(), handle, data))
+        data_bytes = frame_struct.unpack(data)
+        if handle == COMMAND_HANDLE and data_bytes[2] == 0x04:
+            with self.lock:
+                self.data[14] = data_bytes[6]
+
+
+class SimDescriptor:
+    def __init__(self, peripheral, uuid, handle):
+        self.peripheral = peripheral
+        self.uuid = uuid
+        self.handle = handle
+
+    def read(self):
+        return self.peripheral.readCharacteristic(self.handle)
+
+    def write(self, val, withResponse=False):
+        self.peripheral.writeCharacteristic(self.handle, val, withResponse)
+
+
+class SimCharacteristic:
+    props = {"BROADCAST": 0b00000001,
+             "READ": 0b00000010,
+             "WRITE_NO_RESP": 0b00000100,
+             "WRITE": 0b00001000,
+             "NOTIFY": 0b00010000,
+             "INDICATE": 0b00100000,
+             "WRITE_SIGNED": 0b01000000,
+             "EXTENDED": 0b10000000,
+             }
+
+    def __init__(self, peripheral, uuid, handle, properties, valHandle, descriptors=()):
+        self.peripheral = peripheral
+        self.uuid = uuid
+        self.handle = handle
+        self.valHandle = valHandle
+        self.properties = properties
+        self.descriptors = descriptors
+
+    def getHandle(self):
+        return self.valHandle
+
+    def read(self):
+        return self.peripheral.readCharacteristic(self.valHandle)
+
+    def write(self, val, withResponse=False):
+        return self.peripheral.writeCharacteristic(self.valHandle, val, withResponse)
+
+    def getDescriptors(self, forUUID=None, hndEnd=0xFFFF):
+        self.peripheral.request(2)
+        return [d for d in self.descriptors if forUUID is None or same_uuid(d.uuid, forUUID)]
+
+
+class SimService:
+    def __init__(self, peripheral, uuid, characteristics):
+        self.peripheral = peripheral
+        self.uuid = uuid
+        self.characteristics = characteristics
+        self.discovered = False
+
+    def getCharacteristics(self, forUUID=None):
+        # Like bluepy, the service discovers all its characteristics once
+        if not self.discovered:
+            self.peripheral.request(len(self.characteristics) + 1)
+            self.discovered = True
+        return [c for c in self.characteristics if forUUID is None or same_uuid(c.uuid, forUUID)]
+
+
+def same_uuid(a, b):
+    return str(a).lower() == str(b).lower()
+
+
+class SimUUID:
+    def __init__(self, val, commonName=None):
+        self.binVal = str(val).lower()
+
+    def __str__(self):
+        return self.binVal
+
+    def __eq__(self, other):
+        return same_uuid(self, other)
+
+    def __ne__(self, other):
+        return not same_uuid(self, other)
+
+    def __hash__(self):
+        return hash(self.binVal)
+
+
+class SimPeripheral:
+    """
+    Drop-in for bluepy's Peripheral, connected to a SimTagger from `devices`.
+    waitForNotifications delivers every frame that has come due since the last call,
+    so rates of several kHz work even though sleep() is much coarser than that.
+    """
+    max_burst = 256
+
+    def __init__(self, deviceAddr=None, addrType='public', iface=None):
+        self.delegate = None
+        self.sim = None
+        self.notifying = False
+        self.next_frame = 0.0
+        self.notifications = 0
+        self.services = None
+        if deviceAddr is not None:
+            self.connect(deviceAddr)
+
+    def connect(self, addr, addrType='public', iface=None):
+        addr = getattr(addr, 'addr', addr)
+        if addr not in devices:
+            raise BTLEDisconnectError("Failed to connect to peripheral %s" % addr)
+        self.sim = devices[addr]
+        self.sim.dropped = False
+        self.deviceAddr = addr
+        self.request()
+
+        offset = self.sim.handle_offset
+        self.id_handle = ID_HANDLE + offset
+        self.telemetry_handle = TELEMETRY_HANDLE + offset
+        self.cccd_handle = CCCD_HANDLE + offset
+        self.command_handles = (COMMAND_HANDLE + offset, CONFIG_HANDLE + offset)
+
+        cccd = SimDescriptor(self, CLIENT_CONFIG, self.cccd_handle)
+        write = SimCharacteristic.props["WRITE"] | SimCharacteristic.props["WRITE_NO_RESP"]
+        self.services = [SimService(self, MAIN_SERVICE, [
+            SimCharacteristic(self, ID_UUID, self.id_handle - 1, SimCharacteristic.props["READ"], self.id_handle),
+            SimCharacteristic(self, TELEMETRY_UUID, self.telemetry_handle - 1, SimCharacteristic.props["NOTIFY"],
+                              self.telemetry_handle, [cccd]),
+            SimCharacteristic(self, COMMAND_UUID, COMMAND_HANDLE + offset - 1, write, COMMAND_HANDLE + offset),
+            SimCharacteristic(self, CONFIG_UUID, CONFIG_HANDLE + offset - 1, write, CONFIG_HANDLE + offset),
+        ])]
+        # Type of every attribute handle, as the descriptor discovery of getDescriptors reports it
+        self.attributes = dict()
+        for c in self.services[0].characteristics:
+            self.attributes[c.handle] = CHARACTERISTIC_DECLARATION
+            self.attributes[c.valHandle] = c.uuid
+            for d in c.descriptors:
+                self.attributes[d.handle] = d.uuid
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def setDelegate(self, delegate_):
+        return self.withDelegate(delegate_)
+
+    def request(self, count=1):
+        if self.sim.round_trip > 0:
+            time.sleep(self.sim.round_trip * count)
+
+    def getServices(self):
+        self.check()
+        self.request(len(self.services) + 1)
+        return self.services
+
+    def getServiceByUUID(self, uuidVal):
+        self.check()
+        self.request()
+        for service in self.services:
+            if same_uuid(service.uuid, uuidVal):
+                return service
+        raise BTLEException("Service %s not found" % uuidVal)
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        self.check()
+        chars = list(())
+        for service in self.services:
+            chars.extend(c for c in service.characteristics if uuid is None or same_uuid(c.uuid, uuid))
+        self.request(len(chars) + 1)
+        return chars
+
+    def getDescriptors(self, startHnd=1, endHnd=0xFFFF):
+        self.check()
+        self.request()
+        return [SimDescriptor(self, self.attributes[handle], handle)
+                for handle in sorted(self.attributes) if startHnd <= handle <= endHnd]
+
+    def readCharacteristic(self, handle):
+        self.check()
+        self.request()
+        if handle == self.id_handle:
+            return self.sim.id_data()
+        if handle == self.telemetry_handle:
+            return self.sim.frame()
+        return b"\x00\x00"
+
+    def writeCharacteristic(self, handle, val, withResponse=False):
+        self.check()
+        if withResponse:
+            self.request()
+        if handle == self.cccd_handle:
+            self.notifying = val[0:1] == b"\x01"
+            self.next_frame = time.time()
+        elif handle in self.command_handles:
+            self.sim.command(handle - self.sim.handle_offset, val)
+        else:
+            raise BTLEException("Bluetooth command failed (code: 1, error: Invalid handle)")
+        return {'rsp': ['wr']}
+
+    def waitForNotifications(self, timeout):
+        self.check()
+        if not self.notifying or self.sim.rate <= 0:
+            time.sleep(timeout)
+            return False
+
+        wait = self.next_frame - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return False
+        if wait > 0:
+            time.sleep(wait)
+
+        interval = 1.0 / self.sim.rate
+        now = time.time()
+        sent = 0
+        while self.next_frame <= now and sent < self.max_burst:
+            data = self.sim.frame()
+            if data is None:
+                # Replay finished
+                self.notifying = False
+                break
+            if self.delegate is not None:
+                self.delegate.handleNotification(self.telemetry_handle, data)
+            self.next_frame += interval
+            sent += 1
+        self.notifications += sent
+        # Don't build up a backlog if the caller stalls
+        if self.next_frame < now - 1.0:
+            self.next_frame = now
+        return sent > 0
+
+    def check(self):
+        if self.sim is None:
+            raise BTLEException("Not connected")
+        if self.sim.dropped:
+            self.sim = None
+            raise BTLEDisconnectError("Device disconnected")
+
+    def disconnect(self):
+        self.sim = None
+        self.notifying = False
+
+
+class SimScanEntry:
+    def __init__(self, sim):
+        self.addr = sim.addr
+        self.addrType = 'public'
+        self.iface = 0
+        self.rssi = sim.rssi
+        self.name = sim.name
+        self.updateCount = 0
+
+    def getValueText(self, sdid):
+        if sdid == 9:
+            return self.name
+        return None
+
+
+class SimScanner:
+    """Drop-in for bluepy's Scanner that advertises every SimTagger in `devices`."""
+    advertising_interval = 0.1
+
+    def __init__(self, iface=0):
+        self.delegate = None
+        self.scanned = dict()
+        self.running = False
+
+    def withDelegate(self, delegate_):
+        self.delegate = delegate_
+        return self
+
+    def start(self, passive=False):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def clear(self):
+        self.scanned = dict()
+
+    def process(self, timeout=10.0):
+        end = time.time() + timeout
+        while True:
+            for sim in list(devices.values()):
+                entry = self.scanned.get(sim.addr)
+                if entry is None:
+                    entry = SimScanEntry(sim)
+                    self.scanned[sim.addr] = entry
+                entry.rssi = sim.rssi
+                entry.updateCount += 1
+                if self.delegate is not None:
+                    self.delegate.handleDiscovery(entry, entry.updateCount <= 1, True)
+            remain = end - time.time()
+            if remain <= 0:
+                break
+            time.sleep(min(remain, self.advertising_interval))
+
+    def getDevices(self):
+        return self.scanned.values()
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.start(passive=passive)
+        self.process(timeout)
+        self.stop()
+        return self.getDevices()
+
+
+class SimDelegate:
+    def __init__(self):
+        pass
+
+    def handleNotification(self, cHandle, data):
+        pass
+
+    def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+        pass
+
+
+def install():
+    """
+    Route Tagger connections and scans to the simulator. When bluepy is not installed
+    a stand-in bluepy.btle module is registered first so tagger.py can be imported.
+    """
+    try:
+        import bluepy.btle
+    except ImportError:
+        btle = types.ModuleType('bluepy.btle')
+        btle.UUID = SimUUID
+        btle.Peripheral = SimPeripheral
+        btle.Scanner = SimScanner
+        btle.DefaultDelegate = SimDelegate
+        btle.Characteristic = SimCharacteristic
+        btle.Descriptor = SimDescriptor
+        btle.BTLEException = BTLEException
+        btle.BTLEDisconnectError = BTLEDisconnectError
+        package = types.ModuleType('bluepy')
+        package.btle = btle
+        sys.modules['bluepy'] = package
+        sys.modules['bluepy.btle'] = btle
+
+    import bleio
+    import tagger
+    bleio.Scanner = SimScanner
+    tagger.Peripheral = SimPeripheral
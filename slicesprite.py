@@ -1,4 +1,87 @@
 import pygame
+from collections import OrderedDict
+
+
+class SliceCache:
+    """
+    Stretched 9-slice surfaces shared between SliceSprites, keyed by
+    (source image, slicing, width, height) so panels and buttons of the same size
+    only pay for the nine smoothscale calls once. Holds at most `size` surfaces,
+    dropping the least recently used. Returned surfaces are shared and must not be drawn on.
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image, slicing, width, height):
+        key = (image, slicing, width, height)
+        surface = self.surfaces.pop(key, None)
+        if surface is None:
+            self.misses += 1
+            surface = generate_slices(image, slicing, width, height)
+        else:
+            self.hits += 1
+        if self.size > 0:
+            self.surfaces[key] = surface
+            while len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+
+def generate_slices(image, slicing, width, height):
+    """
+    Builds the stretched surface for a SliceSprite of the given size.
+    This first creates nine subsurfaces of the original image (corners, edges, and center).
+    Next, each subsurface is appropriately scaled using pygame.transform.smoothscale.
+    Finally, each subsurface is translated in "relative coordinates."
+    Raises appropriate errors if the size cannot fit the center of the original image.
+    """
+    num_slices = 9
+    x, y, w, h = image.get_rect()
+    l, r, t, b = slicing
+    mw = w - l - r
+    mh = h - t - b
+    wr = w - r
+    hb = h - b
+
+    rect_data = [
+        (0, 0, l, t), (l, 0, mw, t), (wr, 0, r, t),
+        (0, t, l, mh), (l, t, mw, mh), (wr, t, r, mh),
+        (0, hb, l, b), (l, hb, mw, b), (wr, hb, r, b),
+    ]
+
+    w, h = width, height
+    mw = w - l - r
+    mh = h - t - b
+    if mw < 0: raise SliceSprite.width_error
+    if mh < 0: raise SliceSprite.height_error
+
+    scales = [
+        (l, t), (mw, t), (r, t),
+        (l, mh), (mw, mh), (r, mh),
+        (l, b), (mw, b), (r, b),
+    ]
+
+    translations = [
+        (0, 0), (l, 0), (l + mw, 0),
+        (0, t), (l, t), (l + mw, t),
+        (0, t + mh), (l, t + mh), (l + mw, t + mh),
+    ]
+
+    sliced_image = pygame.Surface((w, h), pygame.SRCALPHA, 32)
+    for i in range(num_slices):
+        rect = pygame.rect.Rect(rect_data[i])
+        surf_slice = image.subsurface(rect)
+        stretched_slice = pygame.transform.smoothscale(surf_slice, scales[i])
+        sliced_image.blit(stretched_slice, translations[i])
+    return sliced_image
+
 
 class SliceSprite(pygame.sprite.Sprite):
     """
@@ -14,7 +97,8 @@ class SliceSprite(pygame.sprite.Sprite):
         Creates a SliceSprite object.
         _sliced_image is generated in _generate_slices() only when _regenerate_slices is True.
         This avoids recomputing the sliced image whenever each SliceSprite parameter is changed
-        unless absolutely necessary! Additionally, _rect does not have direct @property access
+        unless absolutely necessary! Moving the sprite never regenerates it, only a change of
+        image, slicing or size does. Additionally, _rect does not have direct @property access
         since updating properties of the rect would not be trigger _regenerate_slices.
 
         Args:
@@ -62,7 +146,6 @@ class SliceSprite(pygame.sprite.Sprite):
     @x.setter
     def x(self, new_x):
         self._rect.x = new_x
-        self._regenerate_slices = True
 
     @property
     def y(self):
@@ -71,7 +154,6 @@ class SliceSprite(pygame.sprite.Sprite):
     @y.setter
     def y(self, new_y):
         self._rect.y = new_y
-        self._regenerate_slices = True
 
     @property
     def slicing(self):
@@ -86,55 +168,18 @@ class SliceSprite(pygame.sprite.Sprite):
         return self._rect
 
     def set_rect(self, new_rect):
+        new_rect = pygame.Rect(new_rect)
+        if new_rect.size != self._rect.size:
+            self._regenerate_slices = True
         self._rect = new_rect
-        self._regenerate_slices = True
 
     def _generate_slices(self):
         """
         Internal method required to generate _sliced_image property.
-        This first creates nine subsurfaces of the original image (corners, edges, and center).
-        Next, each subsurface is appropriately scaled using pygame.transform.smoothscale.
-        Finally, each subsurface is translated in "relative coordinates."
-        Raises appropriate errors if rect cannot fit the center of the original image.
+        The stretched surface only depends on the image, slicing and size, so it
+        comes from the shared slice_cache rather than being rebuilt per sprite.
         """
-        num_slices = 9
-        x, y, w, h = self._image.get_rect()
-        l, r, t, b = self._slicing
-        mw = w - l - r
-        mh = h - t - b
-        wr = w - r
-        hb = h - b
-
-        rect_data = [
-            (0, 0, l, t), (l, 0, mw, t), (wr, 0, r, t),
-            (0, t, l, mh), (l, t, mw, mh), (wr, t, r, mh),
-            (0, hb, l, b), (l, hb, mw, b), (wr, hb, r, b),
-        ]
-
-        x, y, w, h = self._rect
-        mw = w - l - r
-        mh = h - t - b
-        if mw < 0: raise SliceSprite.width_error
-        if mh < 0: raise SliceSprite.height_error
-
-        scales = [
-            (l, t), (mw, t), (r, t),
-            (l, mh), (mw, mh), (r, mh),
-            (l, b), (mw, b), (r, b),
-        ]
-
-        translations = [
-            (0, 0), (l, 0), (l + mw, 0),
-            (0, t), (l, t), (l + mw, t),
-            (0, t + mh), (l, t + mh), (l + mw, t + mh),
-        ]
-
-        self._sliced_image = pygame.Surface((w, h), pygame.SRCALPHA, 32)
-        for i in range(num_slices):
-            rect = pygame.rect.Rect(rect_data[i])
-            surf_slice = self.image.subsurface(rect)
-            stretched_slice = pygame.transform.smoothscale(surf_slice, scales[i])
-            self._sliced_image.blit(stretched_slice, translations[i])
+        self._sliced_image = slice_cache.get(self._image, self._slicing, self._rect.width, self._rect.height)
 
     def event(self, event):
         pass
@@ -155,4 +200,7 @@ class SliceSprite(pygame.sprite.Sprite):
         if self._regenerate_slices:
             self._generate_slices()
             self._regenerate_slices = False
-        surface.blit(self._sliced_image, (x, y))
\ No newline at end of file
+        surface.blit(self._sliced_image, (x, y))
+
+
+slice_cache = SliceCache()
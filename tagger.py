@@ -1,27 +1,34 @@
-from bluepy.btle import UUID, Peripheral, Scanner, DefaultDelegate, BTLEException
-import struct
-from threading import Timer
-from blinker import signal
-from utils import print_console
+from bluepy.btle import UUID, Peripheral, DefaultDelegate, Characteristic, Descriptor, BTLEException, \
+    BTLEDisconnectError
+import time
+from eventbus import Event, Subscriptions
+import log
+import mainloop
+from bleio import FrameQueue, TaggerWorker, DiscoveryCache, ScanWorker, GattCache
+from telemetry import *
 import binascii
 import tagmsg
-import json
+from tagmsg import TaggerSignals
+from recorder import TelemetryRecorder
 
 log_id_data = False
 log_telemetry_data = False
+# Raw telemetry capture of every game, None turns it off (main.py --no-record)
+record_telemetry_path = 'telemetry.rec'
+# Handles and type of every tagger connected before, None keeps them in memory only
+gatt_cache_path = 'gatt.cache'
 
-MAIN_SERVICE    = "e6f59d10-8230-4a5c-b22f-c062b1d329e3"
-ID_UUID         = "e6f59d11-8230-4a5c-b22f-c062b1d329e3"
-TELEMETRY_UUID  = "e6f59d12-8230-4a5c-b22f-c062b1d329e3"
-COMMAND_UUID    = "e6f59d13-8230-4a5c-b22f-c062b1d329e3"
-CONFIG_UUID     = "e6f59d14-8230-4a5c-b22f-c062b1d329e3"
-CLIENT_CONFIG   = "00002902-0000-1000-8000-00805f9b34fb"
-
-TYPE_PISTOL = 2
-TYPE_RIFLE = 1
 STATE_IDLE = 0
 STATE_RELOADING = 1
 
+LINK_IDLE = 0
+LINK_SCANNING = 1
+LINK_CONNECTING = 2
+LINK_STREAMING = 3
+LINK_RECOVERING = 4
+
+link_state_names = ('idle', 'scanning', 'connecting', 'streaming', 'recovering')
+
 FIRE_MODE_SINGLE = 0
 FIRE_MODE_BURST = 1
 FIRE_MODE_AUTO = 2
@@ -39,12 +46,46 @@ BUTTON_POWER = 0x10
 BUTTON_RECOIL_CNT = 0x20
 BUTTON_MAX = 0x20
 
+type_names = {
+    TYPE_RIFLE: 'SR-12 Rogue Rifle',
+    TYPE_PISTOL: 'RK-45 Spitfire Pistol',
+}
+
+
+class LinkStats:
+    def __init__(self):
+        self.attempts = 0
+        self.failures = 0
+        self.drops = 0
+        self.reconnects = list(())
+
+    def reconnected(self, seconds):
+        self.reconnects.append(seconds)
+
+    def report(self):
+        text = "%d connect attempts, %d failed, %d drops" % (self.attempts, self.failures, self.drops)
+        if not self.reconnects:
+            return text
+        times = sorted(self.reconnects)
+        return "%s, reconnect ms min %.0f median %.0f p90 %.0f max %.0f" % (
+            text, times[0] * 1000, times[len(times) // 2] * 1000,
+            times[min(len(times) - 1, int(len(times) * 0.9))] * 1000, times[-1] * 1000)
+
 
 class TaggerService:
-    scanner = None
+    """
+    Keeps one tagger connected. The link goes scanning -> connecting -> streaming, and
+    a drop or a failed connect moves it to recovering, which retries the same tagger
+    after a backoff that doubles up to `backoff_max`. After `direct_attempts` failed
+    retries it goes back to scanning. While nothing is found the scan is duty cycled,
+    continuous for `scan_burst` seconds, then `scan_window` out of every `scan_period`.
+    """
+    scan_delegate = None
+    scan_worker = None
+    scan_stopping = None
+    discovered = None
     recoil_device = None
     tagger = None
-    connecting = False
     fire_event = None
     connect_event = None
     recoil_enabled = True
@@ -52,53 +93,181 @@ class TaggerService:
     shot_mode = SHOT_MODE_INDOOR_NO_CONE
     max_ammo = 30
 
+    backoff_base = 0.5
+    backoff_max = 8.0
+    direct_attempts = 5
+    scan_burst = 10.0
+    scan_window = 2.0
+    scan_period = 10.0
+    stop_timeout = 1.0
+
     def __init__(self):
-        self.scanner = Scanner().withDelegate(ScanDelegate(self))
-        # button press signals
-        tagmsg.on_press_reload.connect(self.reload_pressed)
-        tagmsg.on_press_power.connect(self.set_recoil)
-        tagmsg.on_press_action.connect(self.toggle_fire_mode)
+        self.discovered = DiscoveryCache()
+        self.scan_delegate = ScanDelegate(self.discovered)
+        self.gatt_cache = GattCache(gatt_cache_path)
+        # button press signals, handled on the main thread with the rest of the game state
+        self.subscriptions = Subscriptions()
+        self.subscriptions.connect(tagmsg.on_press_reload, self.reload_pressed, context=mainloop.main)
+        self.subscriptions.connect(tagmsg.on_press_power, self.set_recoil, context=mainloop.main)
+        self.subscriptions.connect(tagmsg.on_press_action, self.toggle_fire_mode, context=mainloop.main)
+        self.recorder = None
+        if record_telemetry_path is not None:
+            self.recorder = TelemetryRecorder(record_telemetry_path)
+            self.recorder.attach(tagmsg)
         # reload vars
         self.reload_state = STATE_IDLE
         self.reload_interval = 3.0
         self.reload_timer = None
+        # connection vars
+        self.link_state = LINK_IDLE
+        self.link_timer = None
+        self.attempts = 0
+        self.lost_at = None
+        self.stats = LinkStats()
 
     def reset(self):
         self.reload_state = STATE_IDLE
         if self.reload_timer is not None:
             self.reload_timer.cancel()
+            self.reload_timer = None
+
+    def stop(self):
+        # Disconnects everything this service connected, it can't be started again
+        self.set_link_state(LINK_IDLE)
+        self.stop_scan()
+        tagger = self.tagger
+        self.release_tagger()
+        if tagger is not None and tagger.worker is not None:
+            # Let the worker drop the connection's handlers before reporting
+            tagger.worker.join(self.stop_timeout)
+        self.reset()
+        self.subscriptions.release()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        log.info("Link: %s", self.report())
+
+    def report(self):
+        return "%s, %d tagmsg handlers" % (self.stats.report(), tagmsg.handler_count(tagmsg))
+
+    def set_link_state(self, state):
+        if self.link_timer is not None:
+            self.link_timer.cancel()
+            self.link_timer = None
+        if state != self.link_state:
+            log.debug("Link %s -> %s", link_state_names[self.link_state], link_state_names[state])
+        self.link_state = state
 
     def try_connect(self):
-        print_console("Scanning for Recoil Tagger")
-        tagmsg.on_message.send(self, msg='Scanning')
-        self.connecting = True
+        log.info("Scanning for Recoil Tagger")
+        tagmsg.on_message.send(self, 'Scanning')
+        self.scan()
+
+    def scan(self):
+        self.set_link_state(LINK_SCANNING)
+        self.attempts = 0
+        self.start_scan()
+        self.link_timer = mainloop.timers.call_later(self.scan_burst, self.pause_scan)
+
+    def pause_scan(self):
+        # Nothing found for a while, only listen part of the time to save battery
+        self.stop_scan()
+        self.link_timer = mainloop.timers.call_later(self.scan_period - self.scan_window, self.resume_scan)
+
+    def resume_scan(self):
+        self.start_scan()
+        self.link_timer = mainloop.timers.call_later(self.scan_window, self.pause_scan)
+
+    def start_scan(self):
+        if self.scan_worker is None:
+            self.scan_worker = ScanWorker(self.scan_delegate)
+            self.scan_worker.start()
+
+    def stop_scan(self):
+        if self.scan_worker is not None:
+            self.scan_worker.stop()
+            self.scan_stopping = self.scan_worker
+            self.scan_worker = None
+
+    def scan_stopped(self):
+        # The worker finishes its current process() call after stop()
+        return self.scan_worker is None and (self.scan_stopping is None or not self.scan_stopping.is_alive())
 
     def update(self):
-        if self.connecting and self.recoil_device is None:
-            devices = self.scanner.scan(0.1)
-
-        if self.connecting and self.recoil_device is not None:
-            self.connecting = False
-            self.tagger = Tagger(self.recoil_device, self)
-            self.tagger.connect()
-            tagmsg.on_connect.send(self)
-        else:
+        if self.link_state == LINK_SCANNING:
+            device = self.discovered.find()
+            if device is not None:
+                self.recoil_device = device.entry
+                log.info("Found Recoil Tagger! %s", device.addr)
+                tagmsg.on_message.send(self, 'Tagger Found')
+                self.connect()
+        elif self.tagger is not None:
             self.poll_data()
+        elif self.link_state == LINK_CONNECTING and self.scan_stopped():
+            self.start_tagger()
+
+    def connect(self):
+        # One adapter can't reliably connect during an LE scan, so the tagger is
+        # started from update() once the scan worker has exited
+        self.set_link_state(LINK_CONNECTING)
+        self.stop_scan()
+        self.stats.attempts += 1
+        if self.scan_stopped():
+            self.start_tagger()
+
+    def start_tagger(self):
+        self.tagger = Tagger(self.recoil_device, self, gatt_cache=self.gatt_cache)
+        self.tagger.start()
 
     def poll_data(self):
+        alive = self.tagger.poll_data()
+        if self.link_state == LINK_CONNECTING and self.tagger.connected:
+            self.streaming()
+        if alive is False:
+            self.lost()
+
+    def streaming(self):
+        self.set_link_state(LINK_STREAMING)
+        self.attempts = 0
+        if self.lost_at is not None:
+            self.stats.reconnected(time.time() - self.lost_at)
+            self.lost_at = None
+
+    def lost(self):
+        if self.link_state == LINK_STREAMING:
+            self.stats.drops += 1
+            self.lost_at = time.time()
+            tagmsg.on_message.send(self, 'Disconnected')
+            log.warning("Tagger disconnected, reconnecting")
+        else:
+            self.stats.failures += 1
+        self.release_tagger()
+        self.recover()
+
+    def recover(self):
+        if self.attempts >= self.direct_attempts:
+            log.warning("Tagger %s not reachable, scanning again", self.recoil_device.addr)
+            self.discovered.remove(self.recoil_device.addr)
+            self.recoil_device = None
+            self.try_connect()
+            return
+        delay = min(self.backoff_max, self.backoff_base * (2 ** self.attempts))
+        self.attempts += 1
+        self.set_link_state(LINK_RECOVERING)
+        tagmsg.on_message.send(self, 'Reconnecting')
+        self.link_timer = mainloop.timers.call_later(delay, self.connect)
+
+    def release_tagger(self):
         if self.tagger is not None:
-            if self.tagger.poll_data(1.0) is False:
-                self.tagger = None
-                self.recoil_device = None
-                tagmsg.on_message.send(self, msg='Disconnected')
-                print_console("Polling data returned false. Disconnected")
+            self.tagger.release()
+            self.tagger = None
 
     def set_recoil(self, sender):
         self.recoil_enabled = not self.recoil_enabled
-        tagmsg.on_set_recoil.send(self, recoil=self.recoil_enabled)
+        tagmsg.on_set_recoil.send(self, self.recoil_enabled)
         message = "Recoil is %s " % ('ENABLED' if self.recoil_enabled else 'DISABLED')
-        print_console(message)
-        tagmsg.on_message.send(self, msg=message)
+        log.info(message)
+        tagmsg.on_message.send(self, message)
 
     def toggle_fire_mode(self, sender):
         if self.fire_mode is FIRE_MODE_SINGLE:
@@ -110,64 +279,246 @@ class TaggerService:
         else:
             self.fire_mode = FIRE_MODE_SINGLE
             message = 'Single'
-        tagmsg.on_set_fire_mode.send(self, mode=self.fire_mode, ir_mode=self.shot_mode)
-        tagmsg.on_message.send(self, msg=message)
+        tagmsg.on_set_fire_mode.send(self, self.fire_mode, self.shot_mode)
+        tagmsg.on_message.send(self, message)
 
     def reload_pressed(self, sender):
         if self.reload_state == STATE_IDLE:
             self.start_reload()
         else:
-            print_console("Still Reloading!")
+            log.info("Still Reloading!")
 
     def start_reload(self):
         self.reload_state = STATE_RELOADING
         tagmsg.on_start_reload.send(self)
-        self.reload_timer = Timer(self.reload_interval, self.finish_reload)
-        self.reload_timer.start()
+        self.reload_timer = mainloop.timers.call_later(self.reload_interval, self.finish_reload)
 
     def finish_reload(self):
-        tagmsg.on_finish_reload.send(self, ammo=self.max_ammo)
+        self.reload_timer = None
+        tagmsg.on_finish_reload.send(self, self.max_ammo)
         self.reload_state = STATE_IDLE
 
 
+class TaggerPool:
+    """
+    Connects and polls several taggers from one host, e.g. a field base station.
+    Every tagger has its own BLE worker, so a slow device never stalls the others,
+    and its own TaggerSignals, so telemetry is routed per device instead of through
+    the global tagmsg signals. Subscribe to a tagger's signals from on_tagger_added.
+    One adapter can't reliably connect during an LE scan, so the scan is paused from
+    finding new taggers until their connects have finished.
+    """
+    max_taggers = 8
+
+    def __init__(self):
+        self.taggers = dict()
+        self.discovered = DiscoveryCache()
+        self.scan_delegate = ScanDelegate(self.discovered)
+        self.gatt_cache = GattCache(gatt_cache_path)
+        self.scan_worker = None
+        self.scan_stopping = None
+        self.scanning = False
+        self.on_tagger_added = Event('tagger_added', ('tagger',))
+        self.on_tagger_removed = Event('tagger_removed', ('tagger',))
+
+    def start_scan(self):
+        self.scanning = True
+        self.resume_scan()
+
+    def stop_scan(self):
+        self.scanning = False
+        self.pause_scan()
+
+    def pause_scan(self):
+        if self.scan_worker is not None:
+            self.scan_worker.stop()
+            self.scan_stopping = self.scan_worker
+            self.scan_worker = None
+
+    def resume_scan(self):
+        if self.scan_worker is None:
+            self.scan_worker = ScanWorker(self.scan_delegate)
+            self.scan_worker.start()
+
+    def scan_stopped(self):
+        return self.scan_worker is None and (self.scan_stopping is None or not self.scan_stopping.is_alive())
+
+    def add(self, device):
+        tagger = Tagger(device, self, TaggerSignals(), self.gatt_cache)
+        self.taggers[device.addr] = tagger
+        self.on_tagger_added.send(self, tagger)
+        tagger.start()
+        return tagger
+
+    def remove(self, addr):
+        tagger = self.taggers.pop(addr, None)
+        if tagger is not None:
+            tagger.release()
+            self.discovered.remove(addr)
+            self.on_tagger_removed.send(self, tagger)
+
+    def update(self):
+        for addr, tagger in self.taggers.items():
+            if tagger.poll_data() is False:
+                log.warning("Tagger %s disconnected", addr)
+                self.remove(addr)
+
+        if self.scanning:
+            self.update_scan()
+
+    def update_scan(self):
+        for tagger in self.taggers.values():
+            if tagger.connecting:
+                return
+        found = [device for device in self.discovered.recent() if device.addr not in self.taggers]
+        found = found[:self.max_taggers - len(self.taggers)]
+        if not found:
+            self.resume_scan()
+            return
+        self.pause_scan()
+        if self.scan_stopped():
+            for device in found:
+                self.add(device.entry)
+
+    def stop(self):
+        self.stop_scan()
+        for addr in self.taggers.keys():
+            self.remove(addr)
+
+
 def log_data(data_to_log):
-    output = ' '.join(format(n, '02X') for n in data_to_log)
-    print_console("DATA: %s" %output)
+    log.debug("DATA: %s", binascii.hexlify(data_to_log))
 
 
 def log_bytes(original_data, bytes_to_log, struct_to_log):
-    print_console('Original values: %s' % original_data)
-    print_console('Format string  : %s' % struct_to_log.format)
-    print_console('Uses           : %s, %s' % (struct_to_log.size, 'bytes'))
-    print_console('Packed Value   : %s' % binascii.hexlify(bytes_to_log))
+    log.debug('Original values: %s', original_data)
+    log.debug('Format string  : %s', struct_to_log.format)
+    log.debug('Uses           : %s, %s', struct_to_log.size, 'bytes')
+    log.debug('Packed Value   : %s', binascii.hexlify(bytes_to_log))
 
 
 class ScanDelegate(DefaultDelegate):
-    tagger_service = None
+    discovered = None
 
-    def __init__(self, service):
+    def __init__(self, discovered):
         DefaultDelegate.__init__(self)
-        self.tagger_service = service
+        self.discovered = discovered
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
-        if isNewDev:
-            name = dev.getValueText(9)
-            if name is not None and name.startswith('SRG1'):
-                self.tagger_service.recoil_device = dev
-                print_console("Found Recoil Tagger! %s" % dev.addr)
-                tagmsg.on_message.send(self, msg='Tagger Found')
+        # Called for every advertisement so RSSI and last seen stay fresh
+        name = dev.getValueText(9)
+        if name is not None and name.startswith('SRG1'):
+            self.discovered.update(dev)
 
 
 class DataDelegate(DefaultDelegate):
 
-    def __init__(self, handle):
+    def __init__(self, handle, frames, tagger=None, on_trigger=None):
         DefaultDelegate.__init__(self)
         self.handle = handle
+        self.frames = frames
+        self.tagger = tagger
+        self.on_trigger = on_trigger
+        self.trigger_count = None
+        self.ammo_count = 0
+        self.notified = False
 
     def handleNotification(self, cHandle, data):
         if cHandle == self.handle:
-            data_bytes = struct.unpack("20B", data)
-            tagmsg.on_telemetry_data.send(self, data=data_bytes)
+            stamp = time.time()
+            self.frames.put((stamp, data))
+            if not self.notified:
+                self.notified = True
+                if self.tagger is not None:
+                    self.tagger.first_notification(stamp)
+            if self.on_trigger is not None and self.on_trigger.handlers:
+                self.check_trigger(data, stamp)
+
+    def check_trigger(self, data, stamp):
+        # Runs on the BLE worker thread, so trigger feedback doesn't wait for the main loop
+        buttons, ammo_count = trigger_struct.unpack(data)
+        trigger_count = buttons & 0x0f
+        if self.trigger_count is not None and trigger_count != self.trigger_count:
+            self.on_trigger.send(self.tagger, self.ammo_count == 0, stamp)
+        self.trigger_count = trigger_count
+        self.ammo_count = ammo_count
+
+
+class CommandEncoder:
+    """
+    Command packets for one tagger, built once at connect time.
+    Every fixed packet is packed up front so sending a command is a lookup.
+    The only variable field, the reload ammo count, is patched into one reused buffer.
+    """
+    fire_modes = (FIRE_MODE_SINGLE, FIRE_MODE_BURST, FIRE_MODE_AUTO)
+    shot_modes = (SHOT_MODE_OUTDOOR_NO_CONE, SHOT_MODE_OUTDOOR_WITH_CONE, SHOT_MODE_INDOOR_NO_CONE)
+
+    def __init__(self, tagger_type):
+        self.tagger_type = tagger_type
+
+        data = [0x00] * 20
+        data[0] = 0xF0
+        data[2] = 0x02
+        self.start_reload = frame_struct.pack(*data)
+
+        self.recoil = dict()
+        for enabled in (True, False):
+            data = [0x00] * 20
+            data[0] = 0x10
+            data[2] = 0x02
+            data[3] = 0x03 if enabled else 0x02
+            data[4] = 0xFF
+            self.recoil[enabled] = frame_struct.pack(*data)
+
+        self.ir_configs = dict()
+        for mode in self.fire_modes:
+            for cone in self.shot_modes:
+                self.ir_configs[(mode, cone)] = self.build_ir_config(mode, cone)
+
+        self.reload_data = bytearray(20)
+        self.reload_data[2] = 0x04
+
+    def finish_reload(self, ammo):
+        self.reload_data[6] = ammo
+        # Copy, the write is sent later from the BLE thread
+        return bytes(self.reload_data)
+
+    def ir_config(self, mode, cone):
+        data_bytes = self.ir_configs.get((mode, cone))
+        if data_bytes is None:
+            data_bytes = self.build_ir_config(mode, cone)
+        return data_bytes
+
+    def build_ir_config(self, mode, cone):
+        data = [0x00] * 20
+        data[2] = 0x09
+        data[7] = 0xFF
+        data[8] = 0xFF
+        data[9] = 0x80
+        data[10] = 0x02
+        data[11] = 0x34
+        if mode == FIRE_MODE_SINGLE:
+            data[3] = 0xFE
+            data[4] = 0x00
+        elif mode == FIRE_MODE_BURST:
+            data[3] = 0x03
+            data[4] = 0x03
+            if self.tagger_type == TYPE_RIFLE:
+                data[9] = 0x78
+        else:
+            data[3] = 0xFE
+            data[4] = 0x01
+
+        if cone == SHOT_MODE_INDOOR_NO_CONE:
+            data[5] = 0x19
+            data[6] = 0x00
+        elif cone == SHOT_MODE_OUTDOOR_WITH_CONE:
+            data[5] = 0xFF
+            data[6] = 0xC8
+        else:
+            data[5] = 0xFF
+            data[6] = 0x00
+        return frame_struct.pack(*data)
 
 
 class TelemetryService:
@@ -187,11 +538,19 @@ class TelemetryService:
         self.data = None
         self.data_descriptor = None
         self.data_handle = 0
+        self.commands = None
         self.tagger = tagger
-        tagmsg.on_start_reload.connect(self.start_reload)
-        tagmsg.on_finish_reload.connect(self.finish_reload)
-        tagmsg.on_set_recoil.connect(self.set_recoil)
-        tagmsg.on_set_fire_mode.connect(self.set_ir_config)
+        # Command writes run on the tagger's BLE thread, whichever thread sent the event
+        context = tagger.worker.context if tagger.worker is not None else None
+        signals = self.tagger.signals
+        self.subscriptions = Subscriptions()
+        self.subscriptions.connect(signals.on_start_reload, self.start_reload, context=context)
+        self.subscriptions.connect(signals.on_finish_reload, self.finish_reload, context=context)
+        self.subscriptions.connect(signals.on_set_recoil, self.set_recoil, context=context)
+        self.subscriptions.connect(signals.on_set_fire_mode, self.set_ir_config, context=context)
+
+    def release(self):
+        self.subscriptions.release()
 
     def enable(self):
         if self.service is None:
@@ -206,83 +565,71 @@ class TelemetryService:
             self.data = self.service.getCharacteristics(self.dataUUID)[0]
             self.data_handle = self.data.getHandle()
             self.data_descriptor = self.data.getDescriptors(forUUID=self.dataCCCD)[0]
-            self.data_descriptor.write(b"\x01\x00")
-        self.peripheral.setDelegate(DataDelegate(self.data_handle))
+        self.peripheral.setDelegate(DataDelegate(self.data_handle, self.tagger.frames,
+                                                 self.tagger, self.tagger.signals.on_trigger))
+        self.data_descriptor.write(b"\x01\x00")
+
+    def enable_cached(self, entry):
+        # Same as enable() with the handles of a GattCache entry, nothing is discovered
+        self.id = self.cached_characteristic(self.idUUID, entry['id'])
+        self.control = self.cached_characteristic(self.ctrlUUID, entry['control'])
+        self.config = self.cached_characteristic(self.confUUID, entry['config'])
+        self.data = self.cached_characteristic(self.dataUUID, entry['data'])
+        self.data_handle = self.data.getHandle()
+        # One request for the types of the value and CCCD handles, so handles that moved
+        # to another attribute are caught instead of enabling the wrong one
+        found = dict((d.handle, str(UUID(d.uuid)))
+                     for d in self.peripheral.getDescriptors(self.data_handle, entry['cccd']))
+        if found.get(self.data_handle) != str(self.dataUUID) or found.get(entry['cccd']) != str(self.dataCCCD):
+            raise ValueError("Telemetry is no longer at handle %d" % self.data_handle)
+        self.data_descriptor = Descriptor(self.peripheral, self.dataCCCD, entry['cccd'])
+        self.peripheral.setDelegate(DataDelegate(self.data_handle, self.tagger.frames,
+                                                 self.tagger, self.tagger.signals.on_trigger))
+        self.data_descriptor.write(b"\x01\x00", True)
+
+    def cached_characteristic(self, uuid, handles):
+        handle, value_handle, properties = handles
+        return Characteristic(self.peripheral, uuid, handle, properties, value_handle)
+
+    def handles(self, tagger_type):
+        def characteristic(c):
+            return [c.handle, c.valHandle, c.properties]
+        return {'type': tagger_type,
+                'id': characteristic(self.id),
+                'control': characteristic(self.control),
+                'config': characteristic(self.config),
+                'data': characteristic(self.data),
+                'cccd': self.data_descriptor.handle}
+
+    def forget(self):
+        self.service = None
+        self.id = None
+        self.control = None
+        self.config = None
+        self.data = None
+        self.data_descriptor = None
+        self.data_handle = 0
+
+    def build_commands(self, tagger_type):
+        self.commands = CommandEncoder(tagger_type)
 
     def start_reload(self, sender):
-        data = [0x00] * 20
-        data[0] = 0xF0
-        data[2] = 0x02
-        s = struct.Struct('20B')
-        bytes = s.pack(*data)
-        self.control.write(bytes)
-        print_console("Starting Reload...")
+        self.tagger.write(self.control, self.commands.start_reload)
+        log.info("Starting Reload...")
 
-    def finish_reload(self, sender, **kw):
-        data = [0x00] * 20
-        data[2] = 0x04
-        data[6] = 0x1E # TODO - Replace with actual ammo from kw params
-        s = struct.Struct('20B')
-        byte_data = s.pack(*data)
-        self.control.write(byte_data)
-        print_console("Reload complete!")
-
-    def set_recoil(self, sender, **kw):
-        if 'recoil' not in kw:
-            return
-        enabled = bool(kw['recoil'])
-        data = [0x00] * 20
-        data[0] = 0x10
-        data[2] = 0x02
-        data[3] = 0x03 if enabled else 0x02
-        data[4] = 0xFF
-        s = struct.Struct('20B')
-        data_bytes = s.pack(*data)
-        self.config.write(data_bytes)
-
-    def set_ir_config(self, sender, **kw):
-        mode = FIRE_MODE_SINGLE
-        cone = SHOT_MODE_INDOOR_NO_CONE
-        if 'mode' in kw:
-            mode = kw['mode']
-        if 'ir_mode' in kw:
-            cone = kw['ir_mode']
-        data = [0x00] * 20
-        data[2] = 0x09
-        data[7] = 0xFF
-        data[8] = 0xFF
-        data[9] = 0x80
-        data[10] = 0x02
-        data[11] = 0x34
-        if mode is FIRE_MODE_SINGLE:
-            data[3] = 0xFE
-            data[4] = 0x00
-        elif mode is FIRE_MODE_BURST:
-            data[3] = 0x03
-            data[4] = 0x03
-            if self.tagger.tagger_type is TYPE_RIFLE:
-                data[9] = 0x78
-        else:
-            data[3] = 0xFE
-            data[4] = 0x01
+    def finish_reload(self, sender, ammo=0x1E):
+        self.tagger.write(self.control, self.commands.finish_reload(ammo))
+        log.info("Reload complete!")
 
-        if cone is SHOT_MODE_INDOOR_NO_CONE:
-            data[5] = 0x19
-            data[6] = 0x00
-        elif cone is SHOT_MODE_OUTDOOR_WITH_CONE:
-            data[5] = 0xFF
-            data[6] = 0xC8
-        else:
-            data[5] = 0xFF
-            data[6] = 0x00
+    def set_recoil(self, sender, recoil):
+        self.tagger.write(self.config, self.commands.recoil[bool(recoil)], 'recoil')
 
+    def set_ir_config(self, sender, mode=FIRE_MODE_SINGLE, ir_mode=SHOT_MODE_INDOOR_NO_CONE):
         # write to the config characteristic
-        s = struct.Struct('20B')
-        data_bytes = s.pack(*data)
-        self.config.write(data_bytes)
+        self.tagger.write(self.config, self.commands.ir_config(mode, ir_mode), 'ir_config')
 
     def read_control(self):
-        print_console(self.control.read())
+        log.info("Control: %s", binascii.hexlify(self.control.read()))
 
     def read_id(self):
         return self.id.read()
@@ -319,7 +666,8 @@ class Tagger:
     power_btn_count = 0
     battery_level = 0
     ammo_count = -1
-    ir_events = [IrEvent(), IrEvent()]
+    connect_started = 0.0
+    connect_latency = None
 
     device = None
     peripheral = None
@@ -329,118 +677,195 @@ class Tagger:
     tagger_type = TYPE_PISTOL
     service = None
     ready = False
+    connected = False
+    worker = None
+    frames = None
 
-    def __init__(self, device, service):
+    def __init__(self, device, service, signals=tagmsg, gatt_cache=None):
         self.device = device
         self.service = service
+        # Shared with the other taggers of the service, None always runs service discovery
+        self.gatt_cache = gatt_cache
+        # The global tagmsg signals, or a TaggerSignals when several taggers are connected
+        self.signals = signals
+        self.ir_events = [IrEvent(), IrEvent()]
+        self.decoder = TelemetryDecoder()
         # Data from tagger
-        tagmsg.on_telemetry_data.connect(self.read_telemetry)
+        self.subscriptions = Subscriptions()
+        self.subscriptions.connect(self.signals.on_telemetry_data, self.read_telemetry)
 
-    def reset(self, data_bytes):
+    def reset(self, values):
+        player_id, buttons, counters, back, power, battery, payload, event, ammo = values
         self.ready = True
-        self.player_id = data_bytes[1]
-        self.fire_btn_count = data_bytes[3] & 0x0f
-        self.reload_btn_count = data_bytes[3] & 0xf0
-        self.back_btn_count = data_bytes[4] & 0x0f
-        self.power_btn_count = data_bytes[5] & 0x0f
-        self.battery_level = data_bytes[7]
-        self.ammo_count = data_bytes[14]
-        tagmsg.on_ammo_changed.send(self, ammo=self.ammo_count)
+        self.player_id = player_id
+        self.fire_btn_count = counters & 0x0f
+        self.reload_btn_count = counters & 0xf0
+        self.back_btn_count = back & 0x0f
+        self.power_btn_count = power & 0x0f
+        self.battery_level = battery
+        self.ammo_count = ammo
+        self.signals.on_ammo_changed.send(self, self.ammo_count)
 
     def connect(self):
         if self.device is not None:
-            print_console("Connecting to Tagger")
-            tagmsg.on_message.send(self, msg='Connecting')
+            log.info("Connecting to Tagger")
+            self.message('Connecting')
+            self.connect_started = time.time()
             self.peripheral = Peripheral(self.device)
-            self.services = self.peripheral.getServices()
-            self.chars = self.peripheral.getCharacteristics()
             self.telemetry = TelemetryService(self.peripheral, self)
-            self.telemetry.enable()
-            self.identify_type()
+            if not self.connect_cached():
+                self.discover()
+            self.telemetry.build_commands(self.tagger_type)
 
-    def read_telemetry(self, sender, **kw):
-        if 'data' not in kw:
-            return
-        data_bytes = kw['data']
-        self.telemetry_count += 1
+    def connect_cached(self):
+        if self.gatt_cache is None:
+            return False
+        addr = self.device.addr
+        entry = self.gatt_cache.get(addr)
+        if entry is None:
+            return False
+        try:
+            self.telemetry.enable_cached(entry)
+        except BTLEDisconnectError:
+            raise
+        except (BTLEException, KeyError, TypeError, ValueError) as e:
+            log.warning("Cached handles for %s are stale, discovering: %s", addr, e)
+            self.gatt_cache.invalidate(addr)
+            self.telemetry.forget()
+            return False
+        log.info("Enabled telemetry from cached handles")
+        self.set_type(entry['type'])
+        self.announce_type()
+        return True
+
+    def discover(self):
+        self.services = self.peripheral.getServices()
+        self.chars = self.peripheral.getCharacteristics()
+        self.telemetry.enable()
+        self.identify_type()
+        if self.gatt_cache is not None:
+            self.gatt_cache.put(self.device.addr, self.telemetry.handles(self.tagger_type))
+
+    def first_notification(self, stamp):
+        self.connect_latency = stamp - self.connect_started
+        log.info("First notification %.1f ms after connecting", self.connect_latency * 1000.0)
+
+    def start(self):
+        self.frames = FrameQueue()
+        self.worker = TaggerWorker(self)
+        self.worker.start()
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.stop()
 
-        if self.ready is False:
-            self.reset(data_bytes)
+    @property
+    def connecting(self):
+        return self.worker is not None and self.worker.is_alive() and not self.worker.connected
+
+    def release(self):
+        # The handlers connected on the main thread go now, the connection's own go
+        # in disconnected() when the worker stops
+        self.stop()
+        self.subscriptions.release()
+
+    def disconnected(self):
+        # Runs on the BLE thread as its worker stops
+        if self.telemetry is not None:
+            self.telemetry.release()
+
+    def message(self, msg):
+        # connect() runs on the BLE worker, the message handlers touch the UI
+        mainloop.main.call(self.signals.on_message.send, self, msg)
+
+    def write(self, characteristic, data, key=None):
+        # Writes with the same key that are still queued collapse into the last one
+        if self.worker is not None:
+            self.worker.write(characteristic, data, key)
+        else:
+            characteristic.write(data)
+
+    def read_telemetry(self, sender, data, stamp):
+        self.telemetry_count += 1
         if log_telemetry_data is True:
-            log_data(data_bytes)
+            log_data(data)
 
-        player_id = data_bytes[1]
-        buttons = data_bytes[2]
-        fire_btn_count = data_bytes[3] & 0x0f
-        reload_btn_count = data_bytes[3] & 0xf0
-        back_btn_count = data_bytes[4] & 0x0f
-        power_btn_count = data_bytes[5] & 0x0f
+        values = self.decoder.decode(data)
+        if values is None:
+            return
 
-        self.battery_level = data_bytes[7]
+        if self.ready is False:
+            self.reset(values)
+        player_id, buttons, counters, back, power, battery, payload, event, ammo = values
+        fire_btn_count = counters & 0x0f
+        reload_btn_count = counters & 0xf0
+        back_btn_count = back & 0x0f
+        power_btn_count = power & 0x0f
+
+        self.battery_level = battery
 
         # Check input buttons
         if fire_btn_count != self.fire_btn_count:
             self.fire_btn_count = fire_btn_count
-            print_console("Fire button count changed: %d" % self.telemetry_count)
+            log.debug("Fire button count changed: %d", self.telemetry_count)
             if self.ammo_count > 0:
-                tagmsg.on_press_fire.send(self, empty=False)
+                self.signals.on_press_fire.send(self, False)
             else:
-                print_console("EMPTY")
-                tagmsg.on_press_fire.send(self, empty=True)
+                log.debug("EMPTY")
+                self.signals.on_press_fire.send(self, True)
         if reload_btn_count != self.reload_btn_count:
-            print_console("Pressed reload!")
+            log.info("Pressed reload!")
             self.reload_btn_count = reload_btn_count
-            tagmsg.on_press_reload.send(self)
+            self.signals.on_press_reload.send(self)
         if back_btn_count != self.back_btn_count:
-            print_console("Pressed Back/Mic!")
+            log.info("Pressed Back/Mic!")
             self.back_btn_count = back_btn_count
-            tagmsg.on_press_action.send(self)
+            self.signals.on_press_action.send(self)
         if power_btn_count != self.power_btn_count:
-            print_console("Pressed Power!")
+            log.info("Pressed Power!")
             self.power_btn_count = power_btn_count
-            tagmsg.on_press_power.send(self)
+            self.signals.on_press_power.send(self)
 
         # Update ammo count
-        ammo_count = data_bytes[14]
-        if ammo_count != self.ammo_count:
-            print_console("Ammo: %d" % ammo_count)
-            self.ammo_count = ammo_count
-            tagmsg.on_ammo_changed.send(self, ammo=ammo_count)
+        if ammo != self.ammo_count:
+            log.debug("Ammo: %d", ammo)
+            self.ammo_count = ammo
+            self.signals.on_ammo_changed.send(self, self.ammo_count)
 
         # Validate player ID hasn't changed, but ultimately the Tagger IS the authority
         if player_id != self.player_id:
-            print_console("Player ID changed! Old/New: %d/%d" % (self.player_id, player_id))
+            log.info("Player ID changed! Old/New: %d/%d", self.player_id, player_id)
             self.player_id = player_id
 
-        byte10 = data_bytes[10]
-        event_id = (byte10 & 0xF)
-        if (event_id != 0) and event_id != (self.ir_events[0].last_event_counter & 0xF):
-            byte8 = data_bytes[8]
-            byte9 = data_bytes[9] << 8
-            payload = (byte8 | byte9)
+        event_id = event & 0xF
+        if event_id != 0 and event_id != (self.ir_events[0].last_event_counter & 0xF):
             self.ir_events[0].payload = payload
-            self.ir_events[0].last_event_counter = byte10 & 0xF
-            self.ir_events[0].sensor_source = byte10 >> 4
+            self.ir_events[0].last_event_counter = event_id
+            self.ir_events[0].sensor_source = event >> 4
 
             self.ir_events[0].event_weapon_type = (payload & 0x3C0)
             self.ir_events[0].event_gun_id = (payload & 0xFC00) >> 10
             self.ir_events[0].event_shot_counter = (payload & 7) >> 0
             self.ir_events[0].event_round_counter = (payload & 0x38) >> 3
-            print_console(json.dumps(vars(self.ir_events[0]), sort_keys=True, indent=4, separators=(',', ': ')))
+            ir_event = self.ir_events[0]
+            log.info("IR event %d from sensor %d: payload 0x%04X gun %d weapon 0x%03X shot %d round %d",
+                     ir_event.last_event_counter, ir_event.sensor_source, payload, ir_event.event_gun_id,
+                     ir_event.event_weapon_type, ir_event.event_shot_counter, ir_event.event_round_counter)
 
     def identify_type(self):
         id_data = self.telemetry.read_id()
-        id_bytes = struct.unpack("20B", id_data)
-        if id_bytes[10] == 1:
-            print_console("Found SR-12 Rogue Rifle!")
-            tagmsg.on_message.send(self, msg='SR-12 Rogue Rifle')
-            self.set_type(TYPE_RIFLE)
-        elif id_bytes[10] == 2:
-            print_console("Found RK-45 Spitfire Pistol!")
-            tagmsg.on_message.send(self, msg='RK-45 Spitfire Pistol')
-            self.set_type(TYPE_PISTOL)
+        id_bytes = frame_struct.unpack(id_data)
+        if id_bytes[10] in type_names:
+            self.set_type(id_bytes[10])
+            self.announce_type()
         if log_id_data is True:
-            log_data(id_bytes)
+            log_data(id_data)
+
+    def announce_type(self):
+        name = type_names.get(self.tagger_type)
+        if name is not None:
+            log.info("Found %s!", name)
+            self.message(name)
 
     def set_type(self, tagger_type):
         self.tagger_type = tagger_type
@@ -448,16 +873,22 @@ class Tagger:
     def dump_services(self):
         if self.services is not None:
             for service in self.services:
-                print_console("Service: ", service.uuid)
+                log.info("Service: %s", service.uuid)
             for char in self.chars:
-                print_console("Characteristic: ", char.uuid)
-
-    def poll_data(self, time):
-        if self.peripheral is not None:
-            try:
-                self.peripheral.waitForNotifications(1.0)
-                return True
-            except BTLEException:
-                return False
-        else:
+                log.info("Characteristic: %s", char.uuid)
+
+    def poll_data(self):
+        if self.worker is None:
             return False
+
+        if self.worker.connected and not self.connected:
+            self.connected = True
+            self.signals.on_connect.send(self)
+
+        # Never blocks, the BLE worker does the waiting
+        frame = self.frames.get()
+        while frame is not None:
+            self.signals.on_telemetry_data.send(self, frame[1], frame[0])
+            frame = self.frames.get()
+
+        return self.worker.is_alive()
@@ -1,4 +1,4 @@
-from blinker import signal
+from eventbus import Event
 
 ON_CONNECT = 'connect'
 ON_TELEMETRY = 'telemetry'
@@ -12,18 +12,57 @@ ON_SET_RECOIL = 'set_recoil'
 ON_SET_FIRE_MODE = 'set_fire_mode'
 ON_AMMO_CHANGE = 'ammo_change'
 ON_MESSAGE = 'message'
+ON_TRIGGER = 'trigger'
 
-on_message = signal(ON_MESSAGE)
-on_telemetry_data = signal(ON_TELEMETRY)
-on_ammo_changed = signal(ON_AMMO_CHANGE)
+# Handlers are called as handler(sender, *fields)
+on_message = Event(ON_MESSAGE, ('msg',))
+on_telemetry_data = Event(ON_TELEMETRY, ('data', 'stamp'))
+on_ammo_changed = Event(ON_AMMO_CHANGE, ('ammo',))
 
-on_press_fire = signal(ON_PRESS_FIRE)
-on_press_reload = signal(ON_PRESS_RELOAD)
-on_press_power = signal(ON_PRESS_POWER)
-on_press_action = signal(ON_PRESS_ACTION)
+on_press_fire = Event(ON_PRESS_FIRE, ('empty',))
+# Sent from the BLE worker thread as soon as a notification shows a trigger pull, ahead of
+# on_press_fire which waits for the main loop. Handlers must be quick and thread safe.
+on_trigger = Event(ON_TRIGGER, ('empty', 'stamp'))
+on_press_reload = Event(ON_PRESS_RELOAD)
+on_press_power = Event(ON_PRESS_POWER)
+on_press_action = Event(ON_PRESS_ACTION)
 
-on_connect = signal(ON_CONNECT)
-on_start_reload = signal(ON_START_RELOAD)
-on_finish_reload = signal(ON_FINISH_RELOAD)
-on_set_recoil = signal(ON_SET_RECOIL)
-on_set_fire_mode = signal(ON_SET_FIRE_MODE)
+on_connect = Event(ON_CONNECT)
+on_start_reload = Event(ON_START_RELOAD)
+on_finish_reload = Event(ON_FINISH_RELOAD, ('ammo',))
+on_set_recoil = Event(ON_SET_RECOIL, ('recoil',))
+on_set_fire_mode = Event(ON_SET_FIRE_MODE, ('mode', 'ir_mode'))
+
+
+event_names = ('on_message', 'on_telemetry_data', 'on_ammo_changed', 'on_press_fire', 'on_trigger',
+               'on_press_reload', 'on_press_power', 'on_press_action', 'on_connect', 'on_start_reload',
+               'on_finish_reload', 'on_set_recoil', 'on_set_fire_mode')
+
+
+def handler_count(signals):
+    # Handlers connected to this module's events or a TaggerSignals, steady across reconnects
+    return sum(len(getattr(signals, name).receivers) for name in event_names)
+
+
+class TaggerSignals:
+    """
+    Per-tagger copies of the events a Tagger sends and listens to, for hosts that
+    connect several taggers. Attribute names match this module so either can be used.
+    """
+
+    def __init__(self):
+        self.on_message = Event(ON_MESSAGE, ('msg',))
+        self.on_telemetry_data = Event(ON_TELEMETRY, ('data', 'stamp'))
+        self.on_ammo_changed = Event(ON_AMMO_CHANGE, ('ammo',))
+
+        self.on_press_fire = Event(ON_PRESS_FIRE, ('empty',))
+        self.on_trigger = Event(ON_TRIGGER, ('empty', 'stamp'))
+        self.on_press_reload = Event(ON_PRESS_RELOAD)
+        self.on_press_power = Event(ON_PRESS_POWER)
+        self.on_press_action = Event(ON_PRESS_ACTION)
+
+        self.on_connect = Event(ON_CONNECT)
+        self.on_start_reload = Event(ON_START_RELOAD)
+        self.on_finish_reload = Event(ON_FINISH_RELOAD, ('ammo',))
+        self.on_set_recoil = Event(ON_SET_RECOIL, ('recoil',))
+        self.on_set_fire_mode = Event(ON_SET_FIRE_MODE, ('mode', 'ir_mode'))
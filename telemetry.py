@@ -0,0 +1,46 @@
+import struct
+
+MAIN_SERVICE    = "e6f59d10-8230-4a5c-b22f-c062b1d329e3"
+ID_UUID         = "e6f59d11-8230-4a5c-b22f-c062b1d329e3"
+TELEMETRY_UUID  = "e6f59d12-8230-4a5c-b22f-c062b1d329e3"
+COMMAND_UUID    = "e6f59d13-8230-4a5c-b22f-c062b1d329e3"
+CONFIG_UUID     = "e6f59d14-8230-4a5c-b22f-c062b1d329e3"
+CLIENT_CONFIG   = "00002902-0000-1000-8000-00805f9b34fb"
+
+# Byte 10 of the ID characteristic
+TYPE_PISTOL = 2
+TYPE_RIFLE = 1
+
+FRAME_SIZE = 20
+
+# Raw 20 byte frames, used for ID reads and logging
+frame_struct = struct.Struct('20B')
+
+# Only the telemetry bytes we use, unpacked in one call:
+# 1 player id, 2 button state, 3-5 button counters, 7 battery,
+# 8-9 IR payload (little endian), 10 IR event counter/sensor, 14 ammo
+telemetry_struct = struct.Struct('<xBBBBBxBHB3xB5x')
+
+# Just the trigger counter byte (3) and ammo (14), checked on the BLE worker thread
+trigger_struct = struct.Struct('<3xB10xB5x')
+
+class TelemetryDecoder:
+    """
+    Unpacks telemetry notifications. The tagger repeats the same frame while nothing
+    happens, so decode() catches an identical frame with one bytes comparison and
+    returns None. Any other frame is unpacked in one call into the tuple
+    (player_id, buttons, counters, back, power, battery, ir_payload, ir_event, ammo),
+    which callers unpack into locals and compare with the state they keep.
+    """
+
+    def __init__(self):
+        self.raw = None
+
+    def reset(self):
+        self.raw = None
+
+    def decode(self, data):
+        if data == self.raw:
+            return None
+        self.raw = data
+        return telemetry_struct.unpack(data)
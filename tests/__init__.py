@@ -0,0 +1,4 @@
+import log
+
+# The connect tests log every state change, keep the output to test results
+log.set_level(log.ERROR)
@@ -0,0 +1,102 @@
+import binascii
+import unittest
+import simtagger
+
+simtagger.install()
+
+from bleio import CommandQueue
+from simtagger import SimCharacteristic
+from tagger import CommandEncoder, TYPE_RIFLE, TYPE_PISTOL
+
+# Packets as the per-call builders in TelemetryService produced them before CommandEncoder,
+# keyed by (tagger type, fire mode, shot mode)
+ir_configs = {
+    (TYPE_RIFLE, 0, 0): '000009fe00ff00ffff8002340000000000000000',
+    (TYPE_RIFLE, 0, 1): '000009fe00ffc8ffff8002340000000000000000',
+    (TYPE_RIFLE, 0, 2): '000009fe001900ffff8002340000000000000000',
+    (TYPE_RIFLE, 1, 0): '0000090303ff00ffff7802340000000000000000',
+    (TYPE_RIFLE, 1, 1): '0000090303ffc8ffff7802340000000000000000',
+    (TYPE_RIFLE, 1, 2): '00000903031900ffff7802340000000000000000',
+    (TYPE_RIFLE, 2, 0): '000009fe01ff00ffff8002340000000000000000',
+    (TYPE_RIFLE, 2, 1): '000009fe01ffc8ffff8002340000000000000000',
+    (TYPE_RIFLE, 2, 2): '000009fe011900ffff8002340000000000000000',
+    (TYPE_PISTOL, 0, 0): '000009fe00ff00ffff8002340000000000000000',
+    (TYPE_PISTOL, 0, 1): '000009fe00ffc8ffff8002340000000000000000',
+    (TYPE_PISTOL, 0, 2): '000009fe001900ffff8002340000000000000000',
+    (TYPE_PISTOL, 1, 0): '0000090303ff00ffff8002340000000000000000',
+    (TYPE_PISTOL, 1, 1): '0000090303ffc8ffff8002340000000000000000',
+    (TYPE_PISTOL, 1, 2): '00000903031900ffff8002340000000000000000',
+    (TYPE_PISTOL, 2, 0): '000009fe01ff00ffff8002340000000000000000',
+    (TYPE_PISTOL, 2, 1): '000009fe01ffc8ffff8002340000000000000000',
+    (TYPE_PISTOL, 2, 2): '000009fe011900ffff8002340000000000000000',
+}
+
+
+class RecordingCharacteristic(SimCharacteristic):
+    def __init__(self, handle, properties):
+        SimCharacteristic.__init__(self, None, None, handle - 1, properties, handle)
+        self.writes = list(())
+
+    def write(self, val, withResponse=False):
+        self.writes.append((val, withResponse))
+
+
+class CommandEncoderTest(unittest.TestCase):
+    def test_ir_configs(self):
+        for (tagger_type, mode, cone), packet in ir_configs.items():
+            encoder = CommandEncoder(tagger_type)
+            self.assertEqual(binascii.hexlify(encoder.ir_config(mode, cone)), packet)
+
+    def test_fixed_packets(self):
+        for tagger_type in (TYPE_RIFLE, TYPE_PISTOL):
+            encoder = CommandEncoder(tagger_type)
+            self.assertEqual(binascii.hexlify(encoder.start_reload), 'f000020000000000000000000000000000000000')
+            self.assertEqual(binascii.hexlify(encoder.recoil[True]), '10000203ff000000000000000000000000000000')
+            self.assertEqual(binascii.hexlify(encoder.recoil[False]), '10000202ff000000000000000000000000000000')
+
+    def test_finish_reload(self):
+        encoder = CommandEncoder(TYPE_RIFLE)
+        thirty = encoder.finish_reload(0x1E)
+        twelve = encoder.finish_reload(12)
+        self.assertEqual(binascii.hexlify(thirty), '0000040000001e00000000000000000000000000')
+        self.assertEqual(binascii.hexlify(twelve), '0000040000000c00000000000000000000000000')
+
+
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = CommandQueue()
+        self.control = RecordingCharacteristic(0x11, SimCharacteristic.props["WRITE"])
+        self.config = RecordingCharacteristic(0x14, SimCharacteristic.props["WRITE"] |
+                                              SimCharacteristic.props["WRITE_NO_RESP"])
+
+    def test_keyed_writes_coalesce_in_place(self):
+        self.queue.put(self.config, b'a', 'fire_mode')
+        self.queue.put(self.control, b'b')
+        self.queue.put(self.config, b'c', 'fire_mode')
+        self.queue.put(self.config, b'd', 'fire_mode')
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.coalesced, 2)
+        self.queue.flush()
+        # The coalesced write keeps its place ahead of the later one, with the last value
+        self.assertEqual(self.config.writes, [(b'd', False)])
+        self.assertEqual(self.control.writes, [(b'b', True)])
+        self.assertEqual(self.queue.written, 2)
+
+    def test_unkeyed_writes_all_go_out(self):
+        for data in (b'a', b'b', b'c'):
+            self.queue.put(self.control, data)
+        self.queue.flush()
+        self.assertEqual([data for data, response in self.control.writes], [b'a', b'b', b'c'])
+        self.assertEqual(self.queue.coalesced, 0)
+
+    def test_key_is_free_after_the_write(self):
+        self.queue.put(self.config, b'a', 'recoil')
+        self.queue.flush()
+        self.queue.put(self.config, b'b', 'recoil')
+        self.queue.flush()
+        self.assertEqual([data for data, response in self.config.writes], [b'a', b'b'])
+        self.assertEqual(len(self.queue), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
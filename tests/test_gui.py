@@ -0,0 +1,185 @@
+import os
+import time
+import unittest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+import assets
+import gui
+from gui import Bar, Button, Container, Label, NumberLabel, Panel, dirty_region, input_dispatcher, layout
+
+# Asset paths are relative to the repository root, run the tests from there
+FONT_PATH = 'ui/Fonts/kenvector_future.ttf'
+
+
+def pixels(surface):
+    return surface.get_size(), pygame.image.tostring(surface, 'RGBA')
+
+
+class GuiTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        pygame.display.init()
+        pygame.font.init()
+        pygame.display.set_mode((640, 480), 0, 32)
+
+    @classmethod
+    def tearDownClass(cls):
+        pygame.display.quit()
+
+    def setUp(self):
+        self.font = assets.font(FONT_PATH, 12)
+        self.nodes = list(())
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.release()
+        layout.update()
+        dirty_region.clear()
+        assets.release(self.font)
+
+    def add(self, node):
+        self.nodes.append(node)
+        return node
+
+
+class LabelTest(GuiTestCase):
+    def test_matches_font_render(self):
+        for text in ("Message: Connecting", "AVAWAY To", "Ammo: 30"):
+            label = self.add(Label(self.font, text, (145, 152, 162)))
+            label.update()
+            self.assertEqual(pixels(label.cached_image), pixels(self.font.render(text, True, (145, 152, 162))))
+
+    def test_number_label_redraws_changed_digits(self):
+        label = self.add(NumberLabel(self.font, "Ammo: ", 29, (145, 152, 162)))
+        label.position(10, 20)
+        layout.update()
+        dirty_region.clear()
+        label.set_value(28)
+        rects = dirty_region.take()
+        self.assertEqual(len(rects), 1)
+        self.assertEqual(rects[0].width, label.cell)
+        self.assertEqual(rects[0].x, 10 + label.prefix_width + label.cell)
+
+
+class GlyphCacheTest(GuiTestCase):
+    def test_shared_and_released_with_the_font(self):
+        budget = assets.cache.budget
+        try:
+            a = NumberLabel(self.font, "Ammo: ", 1, (255, 255, 255))
+            b = NumberLabel(self.font, "Ammo: ", 2, (255, 255, 255))
+            c = NumberLabel(self.font, "Ammo: ", 3, (0, 0, 0))
+            self.assertIs(a.glyphs, b.glyphs)
+            self.assertIsNot(a.glyphs, c.glyphs)
+            assets.cache.budget = 0
+            for label in (a, b, c):
+                label.release()
+            assets.release(self.font)
+            keys = [key for key in assets.cache.entries if key[0] == 'derived' or key[:2] == ('font', FONT_PATH)]
+            self.assertEqual(keys, [])
+        finally:
+            assets.cache.budget = budget
+        self.font = assets.font(FONT_PATH, 12)
+
+
+class BarTest(GuiTestCase):
+    def cap(self, layer, right, image):
+        width = right.get_width()
+        return pixels(layer.subsurface((layer.get_width() - width, 0) + right.get_size())), pixels(image)
+
+    def test_caps_from_their_own_layer(self):
+        bar = self.add(Bar('ui/blue_horizontal.bar', 200))
+        right = pygame.Surface(bar.right_back.get_size(), pygame.SRCALPHA, 32)
+        right.fill((0, 0, 0, 0))
+        right.blit(bar.right_back, (0, 0))
+        self.assertEqual(*self.cap(bar.background, bar.right_back, right))
+        # The foreground leaves its right cap to render()
+        clear = pygame.Surface(bar.right_fore.get_size(), pygame.SRCALPHA, 32)
+        clear.fill((0, 0, 0, 0))
+        self.assertEqual(*self.cap(bar.foreground, bar.right_fore, clear))
+
+    def test_tween_runs_on_timers(self):
+        bar = self.add(Bar('ui/red_horizontal.bar', 200))
+        bar.set_percent(0.2, 0.1)
+        timer = bar.tween_timer
+        self.assertTrue(timer.active)
+        self.assertEqual(bar.shown, 1.0)
+        end = time.time() + 2.0
+        steps = 0
+        while bar.tween is not None and time.time() < end:
+            time.sleep(gui.timers.next_delay())
+            gui.timers.run_due()
+            steps += 1
+        self.assertEqual(bar.shown, 0.2)
+        self.assertFalse(timer.active)
+        self.assertGreater(steps, 1)
+
+    def test_release_stops_the_tween(self):
+        bar = Bar('ui/red_horizontal.bar', 200)
+        bar.set_percent(0.5, 1.0)
+        timer = bar.tween_timer
+        bar.release()
+        self.assertFalse(timer.active)
+
+
+class HitTest(GuiTestCase):
+    def button(self, container, x, static=False):
+        button = self.add(Button('ui/PNG/glassPanel.slc', 100, 30, self.font, "B"))
+        button.position(x, 0)
+        container.add_object(button, static)
+        return button
+
+    def container(self, layered=False):
+        container = self.add(Container())
+        container.set_layered(layered)
+        container.position(50, 50)
+        return container
+
+    def test_drawn_last_wins(self):
+        container = self.container()
+        first = self.button(container, 0)
+        second = self.button(container, 50)
+        layout.update()
+        self.assertIs(input_dispatcher.hit((120, 60), pygame.MOUSEBUTTONDOWN), second)
+        self.assertIs(input_dispatcher.hit((60, 60), pygame.MOUSEBUTTONDOWN), first)
+        self.assertIsNone(input_dispatcher.hit((10, 10), pygame.MOUSEBUTTONDOWN))
+
+    def test_dynamic_children_above_static_ones(self):
+        container = self.container(layered=True)
+        dynamic = self.button(container, 0)
+        self.button(container, 50, static=True)
+        layout.update()
+        self.assertIs(input_dispatcher.hit((120, 60), pygame.MOUSEBUTTONDOWN), dynamic)
+
+    def test_released_buttons_stop_hitting(self):
+        container = self.container()
+        button = self.button(container, 0)
+        layout.update()
+        button.release()
+        self.assertIsNone(input_dispatcher.hit((60, 60), pygame.MOUSEBUTTONDOWN))
+
+
+class LayoutTest(GuiTestCase):
+    def test_released_nodes_leave_the_queue(self):
+        panels = [Panel('ui/PNG/metalPanel_blueCorner.slc', 320, 240) for i in range(5)]
+        for i, panel in enumerate(panels):
+            panel.position(i + 1, i + 1)
+        self.assertEqual(len(layout.roots), 5)
+        for panel in panels:
+            panel.release()
+        self.assertEqual(layout.roots, [])
+
+    def test_moves_lay_out_children(self):
+        container = self.add(Container())
+        label = Label(self.font, "Label")
+        container.add_object(label)
+        label.position(5, 6)
+        container.position(100, 200)
+        layout.update()
+        self.assertEqual(label.abs_pos, (105, 206))
+        self.assertEqual(layout.roots, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import threading
+import unittest
+from mainloop import Scheduler, Context
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.timers = Scheduler(self.clock)
+        self.ran = list(())
+
+    def call(self, name, delay):
+        return self.timers.call_later(delay, self.ran.append, name)
+
+    def advance(self, seconds):
+        self.clock.now += seconds
+        self.timers.run_due()
+
+    def test_deadline_order(self):
+        self.call('c', 3.0)
+        self.call('a', 1.0)
+        self.call('b', 2.0)
+        self.advance(5.0)
+        self.assertEqual(self.ran, ['a', 'b', 'c'])
+
+    def test_same_deadline_in_scheduling_order(self):
+        for name in ('a', 'b', 'c', 'd'):
+            self.call(name, 1.0)
+        self.advance(1.0)
+        self.assertEqual(self.ran, ['a', 'b', 'c', 'd'])
+
+    def test_only_due_timers_run(self):
+        self.call('a', 1.0)
+        self.call('b', 2.0)
+        self.advance(1.5)
+        self.assertEqual(self.ran, ['a'])
+        self.assertAlmostEqual(self.timers.next_delay(), 0.5)
+        self.advance(0.5)
+        self.assertEqual(self.ran, ['a', 'b'])
+        self.assertIsNone(self.timers.next_delay())
+
+    def test_cancel(self):
+        handle = self.call('a', 1.0)
+        self.call('b', 2.0)
+        handle.cancel()
+        self.assertFalse(handle.active)
+        self.assertAlmostEqual(self.timers.next_delay(), 2.0)
+        self.advance(2.0)
+        self.assertEqual(self.ran, ['b'])
+
+    def test_call_every(self):
+        handle = self.timers.call_every(1.0, self.ran.append, 'tick')
+        self.call('half', 1.5)
+        for i in range(3):
+            self.advance(1.0)
+        self.assertEqual(self.ran, ['tick', 'half', 'tick', 'tick'])
+        handle.cancel()
+        self.advance(5.0)
+        self.assertEqual(self.ran.count('tick'), 3)
+
+    def test_run_due_is_bounded(self):
+        # A repeating timer that fell far behind runs once per run_due, not until it catches up
+        self.timers.call_every(0.1, self.ran.append, 'tick')
+        self.advance(10.0)
+        self.assertEqual(self.ran, ['tick'])
+        self.assertTrue(self.timers.due())
+
+    def test_timer_scheduled_while_running(self):
+        self.timers.call_later(1.0, self.call, 'later', 0.0)
+        self.advance(1.0)
+        self.assertEqual(self.ran, [])
+        self.timers.run_due()
+        self.assertEqual(self.ran, ['later'])
+
+
+class ContextTest(unittest.TestCase):
+    def test_call_from_owner_runs_now(self):
+        context = Context('test', ident=threading.current_thread().ident)
+        ran = list(())
+        context.call(ran.append, 1)
+        self.assertEqual(ran, [1])
+        self.assertEqual(len(context.calls), 0)
+
+    def test_call_from_other_thread_waits_for_drain(self):
+        context = Context('test', ident=threading.current_thread().ident)
+        ran = list(())
+        callers = [threading.Thread(target=context.call, args=(ran.append, i)) for i in range(3)]
+        for caller in callers:
+            caller.start()
+            caller.join()
+        self.assertEqual(ran, [])
+        context.drain()
+        self.assertEqual(ran, [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
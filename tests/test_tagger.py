@@ -0,0 +1,155 @@
+import time
+import unittest
+import simtagger
+
+simtagger.install()
+
+import mainloop
+import tagger
+import tagmsg
+from simtagger import SimTagger
+
+
+class SimTestCase(unittest.TestCase):
+    timeout = 10.0
+
+    def setUp(self):
+        self.paths = tagger.record_telemetry_path, tagger.gatt_cache_path
+        tagger.record_telemetry_path = None
+        tagger.gatt_cache_path = None
+        self.sims = list(())
+
+    def tearDown(self):
+        for sim in self.sims:
+            simtagger.remove_device(sim.addr)
+        tagger.record_telemetry_path, tagger.gatt_cache_path = self.paths
+
+    def add_sim(self, addr, **kw):
+        sim = simtagger.add_device(SimTagger(addr, rate=50.0, **kw))
+        self.sims.append(sim)
+        return sim
+
+    def run_until(self, update, condition):
+        end = time.time() + self.timeout
+        while not condition():
+            self.assertLess(time.time(), end, "timed out")
+            mainloop.main.drain()
+            mainloop.timers.run_due()
+            update()
+            time.sleep(0.005)
+
+
+class TaggerServiceTest(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.handlers = tagmsg.handler_count(tagmsg)
+        self.sim = self.add_sim('00:00:00:00:01:01', tagger_type=tagger.TYPE_PISTOL)
+        self.service = tagger.TaggerService()
+        self.service.backoff_base = 0.05
+        self.service.try_connect()
+
+    def tearDown(self):
+        self.service.stop()
+        SimTestCase.tearDown(self)
+
+    def run_until_state(self, state):
+        self.run_until(self.service.update, lambda: self.service.link_state == state)
+
+    def test_connect(self):
+        self.run_until_state(tagger.LINK_STREAMING)
+        self.assertEqual(self.service.tagger.tagger_type, tagger.TYPE_PISTOL)
+        # The scan is over before the connect starts
+        self.assertTrue(self.service.scan_stopped())
+        self.assertEqual(self.service.stats.attempts, 1)
+
+    def test_commands_reach_the_tagger(self):
+        self.run_until_state(tagger.LINK_STREAMING)
+        encoder = tagger.CommandEncoder(tagger.TYPE_PISTOL)
+        self.service.reload_pressed(None)
+        self.run_until(self.service.update, lambda: self.sim.writes)
+        self.assertEqual(self.sim.writes[0][1:], (simtagger.COMMAND_HANDLE, encoder.start_reload))
+
+    def test_reconnect_after_drop(self):
+        self.run_until_state(tagger.LINK_STREAMING)
+        streaming = tagmsg.handler_count(tagmsg)
+        for i in range(3):
+            self.sim.drop()
+            self.run_until_state(tagger.LINK_RECOVERING)
+            self.run_until_state(tagger.LINK_STREAMING)
+        self.assertEqual(self.service.stats.drops, 3)
+        self.assertEqual(len(self.service.stats.reconnects), 3)
+        self.assertEqual(tagmsg.handler_count(tagmsg), streaming)
+
+    def test_failed_connects_back_off(self):
+        self.run_until_state(tagger.LINK_STREAMING)
+        simtagger.remove_device(self.sim.addr)
+        self.sim.drop()
+        self.run_until(self.service.update, lambda: self.service.stats.failures >= 2)
+        self.assertEqual(self.service.link_state, tagger.LINK_RECOVERING)
+        simtagger.add_device(self.sim)
+        self.run_until_state(tagger.LINK_STREAMING)
+        self.assertEqual(self.service.attempts, 0)
+
+    def test_stop_releases_handlers(self):
+        self.run_until_state(tagger.LINK_STREAMING)
+        self.service.stop()
+        self.assertEqual(tagmsg.handler_count(tagmsg), self.handlers)
+
+
+class GattCacheTest(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.sim = self.add_sim('00:00:00:00:01:02')
+        self.pool = tagger.TaggerPool()
+
+    def tearDown(self):
+        self.pool.stop()
+        SimTestCase.tearDown(self)
+
+    def connect(self):
+        device = self.pool.add(simtagger.SimScanEntry(self.sim))
+        self.run_until(lambda: None, lambda: device.connect_latency is not None)
+        self.pool.remove(self.sim.addr)
+        device.worker.join()
+        return device
+
+    def test_reconnect_from_cache(self):
+        self.connect()
+        self.assertEqual(len(self.pool.gatt_cache), 1)
+        device = self.connect()
+        self.assertEqual((self.pool.gatt_cache.hits, self.pool.gatt_cache.misses), (1, 1))
+        self.assertEqual(device.tagger_type, tagger.TYPE_RIFLE)
+        # Discovery would have read the ID characteristic
+        self.assertIsNone(device.services)
+
+    def test_moved_handles_fall_back_to_discovery(self):
+        self.connect()
+        for offset in (3, -2):
+            self.sim.handle_offset = offset
+            device = self.connect()
+            self.assertIsNotNone(device.services)
+            entry = self.pool.gatt_cache.get(self.sim.addr)
+            self.assertEqual(entry['data'][1], simtagger.TELEMETRY_HANDLE + offset)
+            self.assertEqual(entry['cccd'], simtagger.CCCD_HANDLE + offset)
+        self.assertEqual(self.pool.gatt_cache.stale, 2)
+
+
+class TaggerPoolTest(SimTestCase):
+    def test_connects_every_tagger(self):
+        for i in range(3):
+            self.add_sim('00:00:00:00:02:%02X' % i)
+        pool = tagger.TaggerPool()
+        pool.start_scan()
+        try:
+            self.run_until(pool.update, lambda: len(pool.taggers) == 3 and
+                           all(t.connected for t in pool.taggers.values()))
+            self.run_until(pool.update, lambda: all(t.telemetry_count > 0 for t in pool.taggers.values()))
+            # Each tagger reports on its own signals
+            signals = set(id(t.signals) for t in pool.taggers.values())
+            self.assertEqual(len(signals), 3)
+        finally:
+            pool.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import simtagger
+
+simtagger.install()
+
+import tagger
+from simtagger import SimTagger
+from tagmsg import TaggerSignals
+from telemetry import TelemetryDecoder
+
+
+class TelemetryDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimTagger('00:00:00:00:00:01', player_id=7, ammo=30)
+        self.decoder = TelemetryDecoder()
+
+    def test_fields(self):
+        self.sim.press_reload()
+        self.sim.pull_trigger()
+        self.sim.press_back()
+        self.sim.press_power()
+        self.sim.set_battery(88)
+        self.sim.ir_hit(0x1234, sensor=2)
+        player_id, buttons, counters, back, power, battery, payload, event, ammo = self.decoder.decode(self.sim.frame())
+        self.assertEqual(player_id, 7)
+        self.assertEqual(counters, 0x11)
+        self.assertEqual((back, power), (1, 1))
+        self.assertEqual(battery, 88)
+        self.assertEqual(payload, 0x1234)
+        self.assertEqual((event & 0xF, event >> 4), (1, 2))
+        self.assertEqual(ammo, 29)
+
+    def test_repeated_frame(self):
+        frame = self.sim.frame()
+        self.assertIsNotNone(self.decoder.decode(frame))
+        self.assertIsNone(self.decoder.decode(frame))
+        self.assertIsNone(self.decoder.decode(self.sim.frame()))
+        self.sim.set_battery(50)
+        self.assertIsNotNone(self.decoder.decode(self.sim.frame()))
+
+    def test_reset(self):
+        frame = self.sim.frame()
+        self.decoder.decode(frame)
+        self.decoder.reset()
+        self.assertIsNotNone(self.decoder.decode(frame))
+
+
+class ReadTelemetryTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = SimTagger('00:00:00:00:00:02', ammo=2)
+        self.signals = TaggerSignals()
+        self.sent = list(())
+        for name in ('on_press_fire', 'on_press_reload', 'on_press_action', 'on_press_power', 'on_ammo_changed'):
+            getattr(self.signals, name).connect(self.recorder(name))
+        self.tagger = tagger.Tagger(None, None, self.signals)
+        self.feed()
+        del self.sent[:]
+
+    def tearDown(self):
+        self.tagger.release()
+
+    def recorder(self, name):
+        def record(sender, *args):
+            self.sent.append((name,) + args)
+        return record
+
+    def feed(self):
+        self.tagger.read_telemetry(None, self.sim.frame(), 0.0)
+
+    def test_first_frame_resets(self):
+        self.assertTrue(self.tagger.ready)
+        self.assertEqual(self.tagger.ammo_count, 2)
+        self.assertEqual(self.tagger.battery_level, 100)
+
+    def test_repeated_frames_send_nothing(self):
+        for i in range(5):
+            self.feed()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.tagger.telemetry_count, 6)
+
+    def test_trigger(self):
+        self.sim.pull_trigger()
+        self.feed()
+        self.assertEqual(self.sent, [('on_press_fire', False), ('on_ammo_changed', 1)])
+        del self.sent[:]
+        self.sim.pull_trigger()
+        self.feed()
+        self.sim.pull_trigger()
+        self.feed()
+        self.assertEqual(self.sent, [('on_press_fire', False), ('on_ammo_changed', 0), ('on_press_fire', True)])
+
+    def test_buttons(self):
+        self.sim.press_reload()
+        self.feed()
+        self.sim.press_back()
+        self.feed()
+        self.sim.press_power()
+        self.feed()
+        self.assertEqual(self.sent, [('on_press_reload',), ('on_press_action',), ('on_press_power',)])
+
+    def test_ir_event(self):
+        self.sim.ir_hit(0x0C4B, sensor=3)
+        self.feed()
+        event = self.tagger.ir_events[0]
+        self.assertEqual((event.payload, event.last_event_counter, event.sensor_source), (0x0C4B, 1, 3))
+        self.assertEqual(event.event_gun_id, 3)
+        self.assertEqual(event.event_shot_counter, 3)
+        self.assertEqual(self.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()